@@ -0,0 +1,132 @@
+# Domoticz stand-in module, used to run plug-in outside Domoticz (for benchmarks)
+#
+#   Only implements what plug-in uses: log functions, Parameters, Devices, Connection and Device.
+#   Connections don't open any socket: harness gives them data by calling plug-in callbacks.
+#
+#   Flying Domotic -  https://github.com/FlyingDomotic/domoticz-mqtt-sync-plugin.git
+
+Parameters = {}                     # Plug-in parameters
+Devices = {}                        # Plug-in devices (unit -> Device)
+connections = {}                    # Last connection created for each name
+heartbeat = 10                      # Last heartbeat interval set by plug-in
+debugging = 0                       # Last debug level set by plug-in
+logCount = {"Debug": 0, "Log": 0, "Status": 0, "Error": 0}  # Count of messages logged, by level
+lastErrors = []                     # Last error messages
+keepErrors = 20                     # Count of error messages kept
+
+# Log functions (messages are counted, not printed, to measure plug-in code only)
+def Debug(message):
+    logCount["Debug"] += 1
+
+def Log(message):
+    logCount["Log"] += 1
+
+def Status(message):
+    logCount["Status"] += 1
+
+def Error(message):
+    logCount["Error"] += 1
+    lastErrors.append(message)
+    if len(lastErrors) > keepErrors:
+        del lastErrors[0]
+
+def Debugging(level):
+    global debugging
+    debugging = level
+
+def Heartbeat(interval):
+    global heartbeat
+    heartbeat = interval
+
+# Connection stand-in (data sent is counted, MQTT pings are kept to be answered by harness)
+class Connection:
+    def __init__(self, Name, Transport, Protocol, Address=None, Port=None):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.connected = False
+        self.sentCount = 0
+        self.sentBytes = 0
+        self.pendingPings = 0
+        self.lastSent = None
+        connections[Name] = self
+
+    def __str__(self):
+        return self.Name
+
+    def Connect(self):
+        self.connected = True
+
+    def Connected(self):
+        return self.connected
+
+    def Connecting(self):
+        return False
+
+    def Disconnect(self):
+        self.connected = False
+
+    def Send(self, Message, Delay=0):
+        self.sentCount += 1
+        self.lastSent = Message
+        if isinstance(Message, dict):
+            if Message.get("Verb") == "PING":
+                self.pendingPings += 1
+            elif "Payload" in Message:
+                self.sentBytes += len(Message["Payload"])
+        else:
+            self.sentBytes += len(Message)
+
+# Device stand-in
+class Device:
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, \
+            Used=0, DeviceID="", Description="", Color=""):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = Options if Options != None else {}
+        self.Used = Used
+        self.DeviceID = DeviceID
+        self.Description = Description
+        self.ID = 100000 + Unit
+        self.nValue = 0
+        self.sValue = ""
+        self.Color = Color
+        self.LastLevel = 0
+        self.updateCount = 0
+
+    def __str__(self):
+        return F"Unit: {self.Unit}, ID: {self.ID}, Name: '{self.Name}', nValue: {self.nValue}, sValue: '{self.sValue}'"
+
+    def Create(self):
+        Devices[self.Unit] = self
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+    def Update(self, nValue=None, sValue=None, Image=None, SignalLevel=None, BatteryLevel=None, Options=None, \
+            TimedOut=None, Name=None, TypeName=None, Type=None, Subtype=None, Switchtype=None, Used=None, \
+            Description=None, Color=None, SuppressTriggers=False):
+        self.updateCount += 1
+        if nValue != None:
+            self.nValue = nValue
+        if sValue != None:
+            self.sValue = sValue
+        if Options != None:
+            self.Options = Options
+        if Name != None:
+            self.Name = Name
+        if Type != None:
+            self.Type = Type
+        if Subtype != None:
+            self.SubType = Subtype
+        if Switchtype != None:
+            self.SwitchType = Switchtype
+        if Color != None:
+            self.Color = Color
@@ -0,0 +1,364 @@
+# Mqtt Sync plug-in benchmarks / Mesures de performance du plug-in Mqtt Sync
+#
+#   Runs plug-in outside Domoticz (using Domoticz stand-in module of this folder), feeding it with synthetic messages,
+#       and reports CPU time per message and memory used by each scenario
+#
+#   Usage: python benchmark/bench.py [--devices 1000] [--rates 10,100,1000] [--duration 60] [--output bench_output.txt]
+#
+#   Each scenario runs in its own process, as plug-in keeps its state in module variables.
+#       CPU is measured in a first run, memory in a second one (as memory tracing slows code down).
+#
+#   Flying Domotic -  https://github.com/FlyingDomotic/domoticz-mqtt-sync-plugin.git
+
+import argparse
+import importlib
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+benchFolder = os.path.dirname(os.path.abspath(__file__))
+pluginFolder = os.path.dirname(benchFolder)
+
+# Virtual clock, replacing time module in plug-in, so that simulated message rates don't need real waits
+class VirtualClock:
+    now = 0                         # Current virtual time
+
+    # Class initialization: start at current time
+    def __init__(self):
+        self.now = time.time()
+
+    # Return virtual time
+    def time(self):
+        return self.now
+
+    # Move virtual time forward
+    def Advance(self, seconds):
+        self.now += seconds
+
+    # Other functions (perf_counter, strptime, mktime...) are those of time module
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+# Return names of scenarios to run
+def scenarioNames(rates):
+    names = ["master cold start", "master warm start", "master resync"]
+    names += [F"master churn {rate}/s" for rate in rates]
+    names += ["slave cold start", "slave resync"]
+    names += [F"slave churn {rate}/s" for rate in rates]
+    return names
+
+# Synthetic domoticz/out message generator (temperature/humidity devices, random values)
+def domoticzOutMessages(deviceCount, rate, duration, clock):
+    messageTime = clock.now
+    for count in range(int(rate * duration)):
+        messageTime += 1 / rate
+        idx = random.randint(1, deviceCount)
+        lastUpdate = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(messageTime))
+        payload = {"Battery": 255, "LastUpdate": lastUpdate, "RSSI": 12, "description": "", "dtype": "Temp + Humidity", \
+            "hwid": "5", "id": F"{idx:04X}", "idx": idx, "name": F"Device {idx}", "nvalue": 0, "stype": "THGN122/123/132", \
+            "svalue1": F"{random.uniform(15, 25):.1f}", "svalue2": str(random.randint(30, 70)), "svalue3": "1", "unit": 1}
+        yield messageTime, json.dumps(payload).encode("UTF-8")
+
+# Synthetic masterValues message generator (versions following those sent at resync)
+def masterValuesMessages(deviceCount, rate, duration, clock, sequence):
+    messageTime = clock.now
+    for count in range(int(rate * duration)):
+        messageTime += 1 / rate
+        idx = random.randint(1, deviceCount)
+        payload = {"allowSlaveUpdate": True, "nValue": 0, "sValue": F"{random.uniform(15, 25):.1f};{random.randint(30, 70)};1", \
+            "LastUpdate": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(messageTime)), "Sequence": sequence, "Version": deviceCount + count + 1}
+        yield messageTime, idx, json.dumps(payload).encode("UTF-8")
+
+# Synthetic masterParameters payload
+def masterParametersPayload(idx, sequence):
+    return json.dumps({"Name": F"Device {idx}", "Type": 82, "SubType": 1, "SwitchType": 0, \
+        "Sequence": sequence, "Version": idx}).encode("UTF-8")
+
+# Create configuration file and Domoticz database for a given count of devices
+def createEnvironment(homeFolder, deviceCount):
+    settings = {"configVersion": "V1.0.2", "masterName": "master", "masterMqttHost": "masterHost", "masterMqttPort": "1883", \
+        "masterDomoticzOutTopic": "domoticz/out", "masterDomoticzUrl": "http://127.0.0.1:8080", \
+        "slaveName": "slave", "slaveMqttHost": "slaveHost", "slaveMqttPort": "1883", "slaveDomoticzUrl": "http://127.0.0.1:8080", \
+        "slaveDevicePrefix": "MqttSync - "}
+    mapping = [{"idx": idx, "allowSlaveUpdate": True} for idx in range(1, deviceCount + 1)]
+    with open(os.path.join(homeFolder, "mqttSync.json"), "w", encoding = 'UTF-8') as configStream:
+        json.dump({"settings": settings, "mapping": mapping}, configStream)
+    database = sqlite3.connect(os.path.join(homeFolder, "domoticz.db"))
+    database.execute("create table DeviceStatus (ID integer primary key, Name text, Type integer, SubType integer, " \
+        +"SwitchType integer, nValue integer, sValue text, Options text, LastUpdate text, Color text)")
+    database.executemany("insert into DeviceStatus values (?, ?, 82, 1, 0, 0, '20.0;50;1', '', '2024-01-01 00:00:00', '')", \
+        [(idx, F"Device {idx}") for idx in range(1, deviceCount + 1)])
+    database.commit()
+    database.close()
+
+# Harness running plug-in callbacks in a scenario
+class Harness:
+    role = ""                       # Plug-in role (Master or Slave)
+    deviceCount = 0                 # Count of synchronized devices
+    clock = None                    # Virtual clock
+    plugin = None                   # Plug-in module
+    variables = None                # Plug-in variables module
+    Domoticz = None                 # Domoticz stand-in module
+    lastHeartbeat = 0               # Virtual time of last heartbeat
+
+    # Class initialization: import plug-in with Domoticz stand-in
+    def __init__(self, role, deviceCount, homeFolder):
+        self.role = role
+        self.deviceCount = deviceCount
+        sys.path.insert(0, benchFolder)
+        sys.path.insert(1, pluginFolder)
+        import Domoticz
+        self.Domoticz = Domoticz
+        Domoticz.Parameters.update({"HomeFolder": homeFolder + os.sep, "Mode1": "mqttSync.json", "Mode5": role, \
+            "Mode6": "Normal", "Key": "MqttSync", "HardwareID": 1, "DomoticzVersion": "2024.7", "Address": "", \
+            "Username": "", "Password": "", "Database": os.path.join(homeFolder, "domoticz.db")})
+        import plugin
+        import variables
+        self.plugin = plugin
+        self.variables = variables
+        self.clock = VirtualClock()
+        plugin.time = self.clock
+
+    # Return a connection created by plug-in
+    def Connection(self, name):
+        return self.Domoticz.connections[name]
+
+    # Open a connection created by plug-in (and acknowledge MQTT connection)
+    def Open(self, name):
+        connection = self.Connection(name)
+        self.plugin.onConnect(connection, 0, "")
+        if connection.Protocol == "MQTT":
+            self.plugin.onMessage(connection, {"Verb": "CONNACK"})
+        return connection
+
+    # Answer MQTT pings, as long as plug-in sends new ones
+    def Pump(self):
+        pinged = True
+        while pinged:
+            pinged = False
+            for connection in list(self.Domoticz.connections.values()):
+                if connection.pendingPings and connection.Connected():
+                    connection.pendingPings -= 1
+                    pinged = True
+                    self.plugin.onMessage(connection, {"Verb": "PINGRESP"})
+
+    # Call heartbeat if its interval elapsed
+    def Heartbeat(self):
+        if self.clock.now - self.lastHeartbeat >= self.Domoticz.heartbeat:
+            self.lastHeartbeat = self.clock.now
+            self.plugin.onHeartbeat()
+
+    # Count of messages sent by plug-in on slave MQTT
+    def SlavePublished(self):
+        return sum(connection.sentCount for name, connection in self.Domoticz.connections.items() \
+            if name.startswith(self.variables.slaveConnection))
+
+    # Start master up to first resync (returns count of messages handled)
+    def StartMaster(self):
+        plugin = self.plugin
+        plugin.onStart()
+        self.lastHeartbeat = self.clock.now
+        connection = self.Open(self.variables.name2IdxConnection)
+        deviceList = [{"idx": str(idx), "Name": F"Device {idx}"} for idx in range(1, self.deviceCount + 1)]
+        plugin.onMessage(connection, {"Status": "200", "Data": json.dumps({"result": deviceList}).encode("UTF-8")})
+        connection = self.Open(self.variables.masterConnection)
+        plugin.onMessage(connection, {"Verb": "SUBACK"})
+        for link in self.variables.slaveLinks:
+            self.Open(link.connectionName)
+        self.Pump()
+        return self.deviceCount
+
+    # Stop master (saving its state), and reset plug-in variables as a new Domoticz run would
+    def StopMaster(self):
+        self.plugin.onStop()
+        self.Domoticz.connections.clear()
+        importlib.reload(self.variables)
+
+    # Start master from saved state, up to first resync (device definitions refresh is left pending)
+    def WarmStartMaster(self):
+        self.plugin.onStart()
+        self.lastHeartbeat = self.clock.now
+        for link in self.variables.slaveLinks:
+            self.Open(link.connectionName)
+        self.Pump()
+        return self.deviceCount
+
+    # Reconnect master to slave MQTT, without slave state (full resync)
+    def ResyncMaster(self):
+        for link in self.variables.slaveLinks:
+            self.plugin.onMessage(self.Connection(link.connectionName), {"Verb": "CONNACK"})
+        self.Pump()
+        return self.deviceCount
+
+    # Prepare domoticz/out messages
+    def PrepareMasterChurn(self, rate, duration):
+        return list(domoticzOutMessages(self.deviceCount, rate, duration, self.clock))
+
+    # Send domoticz/out messages to master
+    def MasterChurn(self, messages):
+        plugin = self.plugin
+        connection = self.Connection(self.variables.masterConnection)
+        topic = self.variables.domoticzOutTopic
+        for messageTime, payload in messages:
+            self.clock.now = messageTime
+            plugin.onMessage(connection, {"Verb": "PUBLISH", "Topic": topic, "Payload": payload})
+            self.Heartbeat()
+            self.Pump()
+        return len(messages)
+
+    # Start slave and connect it to slave MQTT
+    def StartSlave(self):
+        self.plugin.onStart()
+        self.lastHeartbeat = self.clock.now
+        self.Open(self.variables.slaveLinks[0].connectionName)
+
+    # Send parameters and values of all devices to slave (as done by master at resync)
+    def SlaveResync(self):
+        plugin = self.plugin
+        link = self.variables.slaveLinks[0]
+        connection = self.Connection(link.connectionName)
+        sequence = "2024-01-01 00:00:00"
+        for idx in range(1, self.deviceCount + 1):
+            plugin.onMessage(connection, {"Verb": "PUBLISH", "Topic": F"{link.rootTopic}/masterParameters/{idx}", \
+                "Payload": masterParametersPayload(idx, sequence)})
+            plugin.onMessage(connection, {"Verb": "PUBLISH", "Topic": F"{link.rootTopic}/masterValues/{idx}", \
+                "Payload": json.dumps({"allowSlaveUpdate": True, "nValue": 0, "sValue": "20.0;50;1", \
+                    "LastUpdate": "2024-01-01 00:00:00", "Sequence": sequence, "Version": idx}).encode("UTF-8")})
+        plugin.onHeartbeat()
+        return 2 * self.deviceCount
+
+    # Prepare masterValues messages
+    def PrepareSlaveChurn(self, rate, duration):
+        link = self.variables.slaveLinks[0]
+        return [(messageTime, F"{link.rootTopic}/masterValues/{idx}", payload) for messageTime, idx, payload \
+            in masterValuesMessages(self.deviceCount, rate, duration, self.clock, "2024-01-01 00:00:00")]
+
+    # Send masterValues messages to slave
+    def SlaveChurn(self, messages):
+        plugin = self.plugin
+        connection = self.Connection(self.variables.slaveLinks[0].connectionName)
+        for messageTime, topic, payload in messages:
+            self.clock.now = messageTime
+            plugin.onMessage(connection, {"Verb": "PUBLISH", "Topic": topic, "Payload": payload})
+            self.Heartbeat()
+        return len(messages)
+
+# Run one scenario (in current process), returning its results
+def runScenario(name, deviceCount, duration, measure):
+    homeFolder = tempfile.mkdtemp(prefix="mqttSyncBench")
+    try:
+        createEnvironment(homeFolder, deviceCount)
+        role = "Master" if name.startswith("master") else "Slave"
+        harness = Harness(role, deviceCount, homeFolder)
+        # Prepare scenario (setup not measured)
+        if name == "master cold start":
+            action = harness.StartMaster
+        elif name == "master warm start":
+            harness.StartMaster()
+            harness.StopMaster()
+            action = harness.WarmStartMaster
+        elif name == "master resync":
+            harness.StartMaster()
+            action = harness.ResyncMaster
+        elif name.startswith("master churn"):
+            harness.StartMaster()
+            messages = harness.PrepareMasterChurn(float(name.split(" ")[2].split("/")[0]), duration)
+            action = lambda: harness.MasterChurn(messages)
+        elif name == "slave cold start":
+            harness.StartSlave()
+            action = harness.SlaveResync
+        elif name == "slave resync":
+            harness.StartSlave()
+            harness.SlaveResync()
+            action = harness.SlaveResync
+        else:
+            harness.StartSlave()
+            harness.SlaveResync()
+            messages = harness.PrepareSlaveChurn(float(name.split(" ")[2].split("/")[0]), duration)
+            action = lambda: harness.SlaveChurn(messages)
+        publishedBefore = harness.SlavePublished()
+        # Run measured part
+        result = {"scenario": name, "devices": deviceCount}
+        if measure == "memory":
+            tracemalloc.start()
+            action()
+            result["retainedBytes"], result["peakBytes"] = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            startCpu = time.process_time()
+            startWall = time.perf_counter()
+            messageCount = action()
+            result["cpuSeconds"] = time.process_time() - startCpu
+            result["wallSeconds"] = time.perf_counter() - startWall
+            result["messages"] = messageCount
+            result["published"] = harness.SlavePublished() - publishedBefore
+            result["errors"] = harness.Domoticz.logCount["Error"]
+            result["lastErrors"] = harness.Domoticz.lastErrors[-3:]
+        return result
+    finally:
+        shutil.rmtree(homeFolder, ignore_errors=True)
+
+# Run a scenario in a new process, returning its results
+def runScenarioProcess(name, arguments, measure):
+    command = [sys.executable, os.path.abspath(__file__), "--scenario", name, "--measure", measure, \
+        "--devices", str(arguments.devices), "--duration", str(arguments.duration), "--seed", str(arguments.seed)]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(F"Scenario {name} failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+# Format results as a table
+def formatResults(results, arguments):
+    lines = []
+    lines.append(F"Mqtt Sync benchmark - {arguments.devices} devices, churn duration {arguments.duration}s, " \
+        +F"Python {sys.version.split()[0]}, {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    lines.append("")
+    lines.append(F"{'Scenario':<24}{'Messages':>10}{'Sent':>11}{'CPU (ms)':>11}{'CPU/msg (us)':>14}" \
+        +F"{'Peak mem (KiB)':>16}{'Retained (KiB)':>16}{'Errors':>8}")
+    for result in results:
+        perMessage = result["cpuSeconds"] / result["messages"] * 1e6 if result["messages"] else 0
+        lines.append(F"{result['scenario']:<24}{result['messages']:>10}{result['published']:>11}" \
+            +F"{result['cpuSeconds'] * 1000:>11.1f}{perMessage:>14.1f}" \
+            +F"{result['peakBytes'] / 1024:>16.1f}{result['retainedBytes'] / 1024:>16.1f}{result['errors']:>8}")
+    for result in results:
+        for error in result["lastErrors"]:
+            lines.append(F"{result['scenario']}: {error}")
+    return "\n".join(lines) + "\n"
+
+# Main entry: run all scenarios (or one, when called for a given scenario)
+def main():
+    parser = argparse.ArgumentParser(description="Mqtt Sync plug-in benchmarks")
+    parser.add_argument("--devices", type=int, default=1000, help="count of synchronized devices")
+    parser.add_argument("--rates", default="10,100,1000", help="churn rates (messages per second), comma separated")
+    parser.add_argument("--duration", type=float, default=60, help="churn duration (simulated seconds)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of synthetic messages")
+    parser.add_argument("--output", default=os.path.join(pluginFolder, "bench_output.txt"), help="results file")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--measure", default="cpu", help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    random.seed(arguments.seed)
+
+    if arguments.scenario:
+        print(json.dumps(runScenario(arguments.scenario, arguments.devices, arguments.duration, arguments.measure)))
+        return
+
+    results = []
+    for name in scenarioNames([int(rate) for rate in arguments.rates.split(",")]):
+        result = runScenarioProcess(name, arguments, "cpu")
+        result.update(runScenarioProcess(name, arguments, "memory"))
+        results.append(result)
+        print(F"{name}: {result['messages']} messages, {result['cpuSeconds'] * 1000:.1f} ms CPU", file=sys.stderr)
+    report = formatResults(results, arguments)
+    print(report, end="")
+    with open(arguments.output, "w", encoding = 'UTF-8') as outputStream:
+        outputStream.write(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Mqtt Sync plug-in slave command tests / Tests des commandes venant de l'esclave
+#
+#   Checks that last command sent by slave reaches master Domoticz API when rate limiter coalesces commands
+#       and API update fails (server error, connection lost or connection refused)
+#
+#   Usage: python benchmark/test_commands.py
+#
+#   Uses benchmark harness (Domoticz stand-in and virtual clock), no real server is needed.
+#
+#   Flying Domotic -  https://github.com/FlyingDomotic/domoticz-mqtt-sync-plugin.git
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from bench import Harness, createEnvironment
+
+# Master receiving commands from slave, with a rate limit of 1 command per second and device
+class SlaveCommandsTest(unittest.TestCase):
+    harness = None                  # Benchmark harness running master
+    homeFolder = ""                 # Temporary Domoticz home folder
+
+    # Create environment with rate limit, and start master
+    def setUp(self):
+        self.homeFolder = tempfile.mkdtemp(prefix="mqttSyncTest")
+        createEnvironment(self.homeFolder, 3)
+        configFile = os.path.join(self.homeFolder, "mqttSync.json")
+        with open(configFile, encoding = 'UTF-8') as configStream:
+            config = json.load(configStream)
+        config["settings"].update({"commandRate": "1", "commandBurst": "1"})
+        with open(configFile, "w", encoding = 'UTF-8') as configStream:
+            json.dump(config, configStream)
+        self.harness = Harness("Master", 3, self.homeFolder)
+        self.harness.StartMaster()
+
+    # Stop master and remove environment
+    def tearDown(self):
+        self.harness.StopMaster()
+        shutil.rmtree(self.homeFolder, ignore_errors=True)
+
+    # Send a "Set Level" command from slave
+    def SendLevel(self, level):
+        link = self.harness.variables.slaveLinks[0]
+        self.harness.plugin.onMessage(self.harness.Connection(link.connectionName), {"Verb": "PUBLISH", \
+            "Topic": F"{link.rootTopic}/{self.harness.variables.slaveValues}/1", \
+            "Payload": json.dumps({"Command": "Set Level", "Level": level, "Color": ""}).encode("UTF-8")})
+
+    # Return API update connection
+    def ApiConnection(self):
+        return self.harness.Connection(self.harness.variables.sendSlaveUpdateConnection)
+
+    # Answer API update sent, with a given HTTP status
+    def Answer(self, status):
+        self.harness.plugin.onMessage(self.ApiConnection(), {"Status": str(status), "Data": b""})
+
+    # Move virtual time forward, running heartbeats and opening API connection when asked for
+    def Wait(self, seconds):
+        end = self.harness.clock.now + seconds
+        while self.harness.clock.now < end:
+            self.harness.clock.Advance(1)
+            self.harness.Heartbeat()
+            connection = self.harness.Domoticz.connections.get(self.harness.variables.sendSlaveUpdateConnection)
+            if connection != None and connection.Connected() and connection.sentCount == 0:
+                self.harness.Open(connection.Name)
+
+    # Send 3 levels, first one being sent at once, and last ones coalesced by rate limiter
+    def SendLevels(self):
+        self.SendLevel(10)
+        self.harness.Open(self.harness.variables.sendSlaveUpdateConnection)
+        self.assertIn("level=10", self.ApiConnection().lastSent["URL"])
+        self.SendLevel(20)
+        self.SendLevel(30)
+
+    # Check that last level was sent and accepted, and nothing is left
+    def CheckLastLevelSent(self):
+        self.assertIn("level=30", self.ApiConnection().lastSent["URL"])
+        self.Answer(200)
+        sender = self.harness.variables.apiUpdateSender
+        self.assertEqual(len(sender.queue), 0)
+        self.assertEqual(sender.inFlight, None)
+        self.assertEqual(self.harness.variables.commandLimiter.held, {})
+
+    # Server error on first command: it's retried, then last level is sent
+    def testServerError(self):
+        self.SendLevels()
+        self.Answer(500)
+        self.Wait(10)
+        self.assertIn("level=10", self.ApiConnection().lastSent["URL"])
+        self.Answer(200)
+        self.CheckLastLevelSent()
+
+    # Connection lost after last level has been queued: first command is replaced, last level is sent
+    def testDisconnect(self):
+        self.SendLevels()
+        self.Wait(1)
+        self.ApiConnection().Disconnect()
+        self.harness.plugin.onDisconnect(self.ApiConnection())
+        self.Wait(10)
+        self.CheckLastLevelSent()
+
+    # Connection refused: it's opened again later, and last level (replacing first one, not yet sent) is sent
+    def testConnectFailed(self):
+        self.SendLevel(10)
+        self.ApiConnection().Disconnect()
+        self.harness.plugin.onConnect(self.ApiConnection(), 1, "Connection refused")
+        self.SendLevel(20)
+        self.SendLevel(30)
+        self.Wait(10)
+        self.assertEqual(self.ApiConnection().sentCount, 1)
+        self.CheckLastLevelSent()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -44,13 +44,24 @@ try:
 except:
     pass
 
-from urllib.parse import urlparse
+from urllib.parse import urlparse, quote
 import json
 import sqlite3
 import base64
 import variables
 from datetime import datetime
 import os
+import heapq
+import hashlib
+import functools
+import bisect
+import random
+import math
+import zlib
+import sys
+from types import MappingProxyType
+from collections import deque, OrderedDict, Counter
+import time
 
 # Local MQTT client class
 class MqttClient:
@@ -63,6 +74,13 @@ class MqttClient:
     lwtData = ""                    # Last Will data
     lastSubscribedTopics = ""       # Last subscribed topic(s)
     connection = None               # MQTT connection object
+    lastSendTime = 0                # Time of last message sent (a ping is only needed after an idle period)
+    failures = 0                    # Count of connection attempts since last connection acknowledgment
+    nextOpenTime = 0                # Time before which connection is not reopened (after a failure)
+    inFlight = None                 # QoS 1 messages sent and not yet acknowledged (packet id -> (topic, payload, retain))
+    waiting = None                  # QoS 1 messages waiting for a free place in in-flight window (topic, payload, retain)
+    lastPacketId = 0                # Last packet identifier given to a QoS 1 message
+    publishedCounter = ""           # Name of published messages counter (composed once)
 
     # Class initialization: save parameters and open connection
     def __init__(self, name, address, port, username = None, password = None, lwtTopic = None, lwtData = None):
@@ -74,6 +92,9 @@ class MqttClient:
         self.password = password
         self.lwtTopic = lwtTopic
         self.lwtData = lwtData
+        self.inFlight = OrderedDict()
+        self.waiting = deque()
+        self.publishedCounter = F"published.{name}"
 
     # Class default string
     def __str__(self):
@@ -93,9 +114,40 @@ class MqttClient:
         Parameters['Password'] = str(self.password)
         if self.username != "":
             Domoticz.Debug(F"{marker} Using {Parameters['Username']}/{Parameters['Password']}")
+        # Wait longer before next attempt after each consecutive failure, with jitter to avoid synchronized retries
+        self.failures += 1
+        delay = min(variables.reconnectMaxDelay, variables.reconnectDelay * 2 ** min(self.failures - 1, 16))
+        self.nextOpenTime = time.time() + delay * random.uniform(0.5, 1.0)
+        if self.failures > 1:
+            Domoticz.Debug(F"{marker} Attempt {self.failures}, next one not before {self.nextOpenTime - time.time():.0f} seconds")
         self.connection = Domoticz.Connection(Name=self.name, Transport="TCP/IP", Protocol="MQTT", Address=self.address, Port=self.port)
         self.connection.Connect()
 
+    # Called when connection is acknowledged, next reconnection can be immediate
+    #   QoS 1 messages not acknowledged before disconnection are sent again, flagged as duplicates
+    def OnConnAck(self):
+        self.failures = 0
+        self.nextOpenTime = 0
+        for packetId, message in self.inFlight.items():
+            self.SendAcknowledged(packetId, message, duplicate=True)
+        self.SendWaiting()
+
+    # Returns time of next keep alive check (ping needed or connection reopen allowed)
+    def NextKeepAliveTime(self):
+        if self.connection != None and self.connection.Connected():
+            return self.lastSendTime + variables.pingInterval
+        return self.nextOpenTime
+
+    # Keep connection alive: ping it when idle for a ping interval, or reopen it (not before allowed time) when closed
+    def KeepAlive(self, now):
+        if self.connection != None and self.connection.Connected():
+            if now - self.lastSendTime >= variables.pingInterval:
+                self.Ping()
+        elif self.connection != None and self.connection.Connecting():
+            pass
+        elif now >= self.nextOpenTime:
+            self.Open()
+
     # Connect to MQTT server (or open connction if not active)
     def SendId(self):
         marker = makeMarker("SendId", "MqttClient", self.name)
@@ -107,6 +159,7 @@ class MqttClient:
             else:
                 Domoticz.Log(F"{marker} ID: {ID}")
                 self.connection.Send({'Verb': 'CONNECT', 'ID': ID})
+            self.lastSendTime = time.time()
         else:
             Domoticz.Error(F"{marker} Not initialized, ignoring!!")
 
@@ -119,34 +172,88 @@ class MqttClient:
         # Reconnect if master connection has dropped
         if self.connection.Connected():
                 self.connection.Send({'Verb': 'PING'})
+                self.lastSendTime = time.time()
         elif self.connection.Connecting():
             Domoticz.Debug(F"{marker} Still trying to reconnect to MQTT")
-        else:
+        elif time.time() >= self.nextOpenTime:
             Domoticz.Debug(F"{marker} Reconnecting to MQTT")
             self.Open()
 
     #  Publish a payload on a given topic (and retain flag)
     def Publish(self, topic, payload, retain = 0):
-        marker = makeMarker("Publish", "MqttClient", self.name, F"{topic} ({payload})")
+        self.PublishBytes(topic, payload.encode('utf-8'), retain)
+
+    #  Publish an already encoded payload on a given topic (and retain flag)
+    def PublishBytes(self, topic, payload, retain = 0):
+        marker = makeMarker("Publish", "MqttClient", self.name, lambda: F"{topic} ({payload})")
         if self.connection == None:
             Domoticz.Error(F"{marker} Not initialized, Ignoring")
             return
-        self.connection.Send({'Verb': 'PUBLISH', 'Topic': topic, 'Payload': bytearray(payload, 'utf-8'), 'Retain': retain})
-
-    # Subscribe to topic(s)
-    def Subscribe(self, topics):
-        marker = makeMarker("Subscribe", "MqttClient", self.name, F"{topics}")
+        self.connection.Send({'Verb': 'PUBLISH', 'Topic': topic, 'Payload': payload, 'Retain': retain})
+        self.lastSendTime = time.time()
+        variables.metrics.Count(self.publishedCounter)
+
+    #  Publish an already encoded payload with QoS 1, keeping it until broker acknowledges it (even if not connected)
+    #   Up to qosWindow messages are sent without waiting for acknowledgment, next ones waiting for a free place
+    #   When too many messages are waiting, oldest one having a newer message on same topic is dropped (else oldest one)
+    def PublishAcknowledged(self, topic, payload, retain = 0):
+        marker = makeMarker("PublishAcknowledged", "MqttClient", self.name, ignore=True)
+        self.waiting.append((topic, payload, retain))
+        if len(self.waiting) > variables.qosMaxWaiting:
+            topicCount = Counter(message[0] for message in self.waiting)
+            for message in self.waiting:
+                if topicCount[message[0]] > 1:
+                    self.waiting.remove(message)
+                    Domoticz.Error(F"{marker} Too many messages waiting, dropping message to {message[0]} replaced by a newer one")
+                    break
+            else:
+                Domoticz.Error(F"{marker} Too many messages waiting, message to {self.waiting.popleft()[0]} lost")
+        self.SendWaiting()
+
+    # Send QoS 1 messages waiting, as long as in-flight window is not full
+    def SendWaiting(self):
+        while self.waiting and len(self.inFlight) < variables.qosWindow \
+                and self.connection != None and self.connection.Connected():
+            message = self.waiting.popleft()
+            # Packet identifiers are 1 to 65535, skipping those still in flight
+            self.lastPacketId = self.lastPacketId % 65535 + 1
+            while self.lastPacketId in self.inFlight:
+                self.lastPacketId = self.lastPacketId % 65535 + 1
+            self.inFlight[self.lastPacketId] = message
+            self.SendAcknowledged(self.lastPacketId, message)
+
+    # Send a QoS 1 message with its packet identifier (duplicate flag being set when sent again)
+    def SendAcknowledged(self, packetId, message, duplicate=False):
+        topic, payload, retain = message
+        data = {'Verb': 'PUBLISH', 'Topic': topic, 'Payload': payload, 'Retain': retain, 'QoS': 1, 'PacketIdentifier': packetId}
+        if duplicate:
+            data['Duplicate'] = 1
+        self.connection.Send(data)
+        self.lastSendTime = time.time()
+        variables.metrics.Count(self.publishedCounter)
+
+    # Called when broker acknowledges a QoS 1 message, freeing its place in in-flight window
+    def OnPubAck(self, packetId):
+        marker = makeMarker("OnPubAck", "MqttClient", self.name, ignore=True)
+        if self.inFlight.pop(packetId, None) == None:
+            Domoticz.Debug(F"{marker} Unexpected packet identifier {packetId}")
+        self.SendWaiting()
+
+    # Subscribe to topic(s), with given maximum QoS
+    def Subscribe(self, topics, qos = 0):
+        marker = makeMarker("Subscribe", "MqttClient", self.name, lambda: F"{topics}")
         if self.connection == None:
             Domoticz.Error(F"{marker} Not initialized, Ignoring")
             return
         subscriptionlist = []
         if type(topics).__name__ == "list":
             for topic in topics:
-                subscriptionlist.append({'Topic':topic, 'QoS':0})
+                subscriptionlist.append({'Topic':topic, 'QoS':qos})
         else:
-                subscriptionlist.append({'Topic':topics, 'QoS':0})
+                subscriptionlist.append({'Topic':topics, 'QoS':qos})
         self.lastSubscribedTopics = topics
         self.connection.Send({'Verb': 'SUBSCRIBE', 'Topics': subscriptionlist})
+        self.lastSendTime = time.time()
 
     # Close MQTT connection
     def Close(self):
@@ -161,15 +268,17 @@ class HttpClient:
     address = ""                    # IP address of HTTP server
     port = ""                       # Port of HTTP server
     isHttps = False                 # Is connection using https?
+    isStreamed = False              # Is response read as a raw stream (instead of being buffered by Domoticz)?
     connection = None               # HTTP connection object
 
     # Class initialization: save parameters and open connection
-    def __init__(self, name, address, port, isHttps):
-        marker = makeMarker("__init__", "HttpClient", name, F"{address}, {port}, {isHttps}")
+    def __init__(self, name, address, port, isHttps, isStreamed = False):
+        marker = makeMarker("__init__", "HttpClient", name, F"{address}, {port}, {isHttps}, {isStreamed}")
         self.name = name
         self.address = address
         self.port = port
         self.isHttps = isHttps
+        self.isStreamed = isStreamed
 
     # Class default string
     def __str__(self):
@@ -185,7 +294,9 @@ class HttpClient:
         if (self.connection != None):
             if self.connection.Connected():
                 self.connection.Disconnect()
-        if self.isHttps:
+        if self.isStreamed:
+            self.connection = Domoticz.Connection(Name=self.name, Transport="TCP/IP", Protocol="None", Address=self.address, Port=self.port)
+        elif self.isHttps:
             self.connection = Domoticz.Connection(Name=self.name, Transport="TCP/IP", Protocol="HTTPS", Address=self.address, Port=self.port)
         else:
             self.connection = Domoticz.Connection(Name=self.name, Transport="TCP/IP", Protocol="HTTP", Address=self.address, Port=self.port)
@@ -195,27 +306,655 @@ class HttpClient:
     def Close(self):
         marker = makeMarker("Close", "HttpClient", self.name)
 
+# Local Domoticz API update sender class (queued updates sent on a persistent connection)
+class ApiUpdateSender:
+    httpClient = None               # HTTP client object (kept open between updates)
+    queue = None                    # Queue of updates to send ([idx, apiParams, retryCount] entries)
+    lastByIdx = None                # Last queued update of each idx that can be replaced by a newer one
+    inFlight = None                 # Update sent, waiting for answer
+    retryTime = 0                   # Time before which nothing is sent (after an error)
+    failures = 0                    # Count of consecutive errors
+
+    # Class initialization: save parameters
+    def __init__(self, name, address, port, isHttps):
+        marker = makeMarker("__init__", "ApiUpdateSender", name, F"{address}, {port}, {isHttps}")
+        self.httpClient = HttpClient(name, address, port, isHttps)
+        self.queue = deque()
+        self.lastByIdx = {}
+
+    # Add an update to queue, replacing previous not yet sent one for same idx if allowed
+    def Add(self, idx, apiParams, replaceable=True):
+        marker = makeMarker("Add", "ApiUpdateSender", parameters=lambda: F"{idx}, {apiParams}, queue length={len(self.queue)}")
+        entry = self.lastByIdx.get(idx)
+        if replaceable and entry != None:
+            # Only newest state matters
+            entry[1] = apiParams
+        else:
+            entry = [idx, apiParams, 0]
+            self.queue.append(entry)
+            if replaceable:
+                self.lastByIdx[idx] = entry
+            else:
+                self.lastByIdx.pop(idx, None)
+        variables.metrics.Observe("apiUpdateQueue", len(self.queue), variables.depthBuckets)
+        self.SendNext()
+
+    # Send next update if possible (connection opened when needed)
+    def SendNext(self):
+        if self.inFlight != None or not self.queue or time.time() < self.retryTime:
+            return
+        connection = self.httpClient.connection
+        if connection != None and connection.Connected():
+            entry = self.queue.popleft()
+            if self.lastByIdx.get(entry[0]) is entry:
+                del self.lastByIdx[entry[0]]
+            self.inFlight = entry
+            sendSlaveUpdate(connection, entry[1])
+        elif connection == None or not connection.Connecting():
+            self.httpClient.Open()
+
+    # Called when HTTP connection is opened
+    def OnConnected(self):
+        self.SendNext()
+
+    # Called when an HTTP answer is received
+    def OnResponse(self, status):
+        marker = makeMarker("OnResponse", "ApiUpdateSender", parameters=lambda: F"{status}")
+        entry = self.inFlight
+        self.inFlight = None
+        if status == 200:
+            self.failures = 0
+        elif entry != None:
+            # Retry server errors, forget client errors (bad request, unauthorized...)
+            if status >= 500:
+                self.Retry(entry)
+            else:
+                Domoticz.Error(F"{marker} Update {entry[1]} rejected with status {status}, ignored")
+        self.SendNext()
+
+    # Called when HTTP connection is closed
+    def OnDisconnected(self):
+        if self.inFlight != None:
+            entry = self.inFlight
+            self.inFlight = None
+            self.Retry(entry)
+
+    # Called when HTTP connection can't be opened: wait before reopening it
+    def OnConnectFailed(self, status, description):
+        marker = makeMarker("OnConnectFailed", "ApiUpdateSender", ignore=True)
+        self.Backoff()
+        Domoticz.Log(F"{marker} Connection failed with status {status} ({description}), retrying in {self.retryTime - time.time():.0f} seconds")
+        self.ScheduleRetry()
+
+    # Wait longer after each consecutive error
+    def Backoff(self):
+        self.failures += 1
+        self.retryTime = time.time() + min(variables.apiRetryMaxDelay, variables.apiRetryDelay * 2 ** (self.failures - 1))
+
+    # Schedule sending of queued updates once retry delay elapsed
+    def ScheduleRetry(self):
+        if self.queue:
+            scheduleTask("apiUpdateRetry", self.retryTime - time.time(), self.SendNext)
+
+    # Requeue an update after an error, waiting longer after each consecutive error
+    def Retry(self, entry):
+        marker = makeMarker("Retry", "ApiUpdateSender", ignore=True)
+        self.Backoff()
+        entry[2] += 1
+        if entry[2] > variables.apiMaxRetries:
+            Domoticz.Error(F"{marker} Update {entry[1]} failed {entry[2]} times, ignored")
+        elif entry[0] in self.lastByIdx:
+            # A newer update for same idx is already queued
+            Domoticz.Log(F"{marker} Update {entry[1]} failed, replaced by newer one")
+        else:
+            Domoticz.Log(F"{marker} Update {entry[1]} failed, retrying in {self.retryTime - time.time():.0f} seconds")
+            self.queue.appendleft(entry)
+        self.ScheduleRetry()
+
+# Local rate limiter class (token bucket by key, items above rate being held, latest wins, until a token is available)
+class RateLimiter:
+    name = ""                       # Name of this limiter
+    rate = 0                        # Tokens added per second to each bucket (0 for no limit)
+    burst = 1                       # Maximum tokens of a bucket
+    release = None                  # Function called with (key, item, replaceable) when an item can be sent
+    buckets = None                  # Token bucket by key (key -> [tokens, last refill time])
+    held = None                     # Item held by key, waiting for a token (key -> item)
+
+    # Class initialization: save parameters
+    def __init__(self, name, rate, burst, release):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.release = release
+        self.buckets = {}
+        self.held = {}
+
+    # Take a token of a key if available
+    def TakeToken(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket == None:
+            bucket = [self.burst, now]
+            self.buckets[key] = bucket
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+    # Submit an item: release it now if a token is available, else hold it (replacing item already held for same key)
+    #   A not replaceable item (as a toggle) is released at once, after item held for same key
+    def Submit(self, key, item, replaceable=True):
+        if self.rate <= 0:
+            self.release(key, item, replaceable)
+            return
+        now = time.time()
+        if not replaceable:
+            if key in self.held:
+                self.release(key, self.held.pop(key), True)
+            self.TakeToken(key, now)
+            self.release(key, item, replaceable)
+        elif key not in self.held and self.TakeToken(key, now):
+            self.release(key, item, replaceable)
+        else:
+            if key in self.held:
+                variables.metrics.Count(F"coalesced.{self.name}")
+            self.held[key] = item
+            self.ScheduleRelease(now)
+
+    # Release held items with a token available, and schedule next release
+    def ReleaseHeld(self):
+        now = time.time()
+        for key in list(self.held):
+            if self.TakeToken(key, now):
+                self.release(key, self.held.pop(key), True)
+        self.ScheduleRelease(now)
+
+    # Schedule next release, when first held item will get a token
+    def ScheduleRelease(self, now):
+        if self.held:
+            delay = min((1 - self.buckets[key][0]) / self.rate - (now - self.buckets[key][1]) for key in self.held)
+            scheduleTask(F"release.{self.name}", delay, self.ReleaseHeld, earliest=True)
+
+    # Release all held items, without waiting for tokens (at stop)
+    def Flush(self):
+        for key in list(self.held):
+            self.release(key, self.held.pop(key), True)
+        variables.scheduler.Cancel(F"release.{self.name}")
+
+# Local HTTP response reader class, writing body to a file as soon as it's received
+class HttpStreamReader:
+    fileName = ""                   # File to write body into
+    stream = None                   # File stream
+    buffer = b""                    # Received data not yet analyzed (headers, chunk sizes)
+    status = None                   # HTTP status (None until headers received)
+    headersDone = False             # Have headers been received?
+    remaining = None                # Remaining body length (None if not known)
+    chunked = False                 # Is body using chunked transfer encoding?
+    chunkRemaining = 0              # Remaining length of current chunk
+    skipCrLf = False                # Should CR/LF at end of chunk be skipped?
+    received = 0                    # Body length received
+    complete = False                # Has full body been received?
+
+    # Class initialization: open file
+    def __init__(self, fileName):
+        marker = makeMarker("__init__", "HttpStreamReader", parameters=fileName)
+        self.fileName = fileName
+        self.stream = open(fileName, "wb")
+
+    # Analyze received data
+    def Feed(self, data):
+        if not self.headersDone:
+            self.buffer += data
+            end = self.buffer.find(b"\r\n\r\n")
+            if end < 0:
+                return
+            lines = self.buffer[:end].decode("iso-8859-1").split("\r\n")
+            data = self.buffer[end+4:]
+            self.buffer = b""
+            self.status = int(lines[0].split(" ")[1])
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+            self.chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+            if not self.chunked and "content-length" in headers:
+                self.remaining = int(headers["content-length"])
+            self.headersDone = True
+        if self.chunked:
+            self.FeedChunked(data)
+        else:
+            self.Write(data)
+            if self.remaining != None:
+                self.remaining -= len(data)
+                self.complete = self.remaining <= 0
+
+    # Analyze data of a chunked body
+    def FeedChunked(self, data):
+        if self.buffer:
+            data = self.buffer + data
+            self.buffer = b""
+        view = memoryview(data)
+        position = 0
+        while position < len(data) and not self.complete:
+            if self.chunkRemaining > 0:
+                size = min(self.chunkRemaining, len(data) - position)
+                self.Write(view[position:position+size])
+                self.chunkRemaining -= size
+                position += size
+                self.skipCrLf = self.chunkRemaining == 0
+            else:
+                # Read a chunk size line (or CR/LF terminating previous chunk)
+                end = data.find(b"\r\n", position)
+                if end < 0:
+                    self.buffer = bytes(view[position:])
+                    return
+                line = bytes(view[position:end])
+                position = end + 2
+                if self.skipCrLf:
+                    self.skipCrLf = False
+                    continue
+                size = int(line.split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.complete = True
+                else:
+                    self.chunkRemaining = size
+
+    # Write body data to file
+    def Write(self, data):
+        self.stream.write(data)
+        self.received += len(data)
+
+    # Called when connection is closed by server
+    def Disconnected(self):
+        # Body without length or chunks ends with connection
+        if self.headersDone and self.remaining == None and not self.chunked:
+            self.complete = True
+
+    # Close file
+    def Close(self):
+        if self.stream != None:
+            self.stream.close()
+            self.stream = None
+
+# Local device catalog class (devices known by Domoticz, indexed by idx and name)
+class DeviceCatalog:
+    idx2Name = None                 # Idx to name dictionary
+    name2Idx = None                 # Name to idx dictionary
+    duplicateNames = None           # Names used by multiple devices (name -> list of idx)
+
+    # Class initialization: load list of devices (as returned by Domoticz API)
+    def __init__(self, listOfDevices = None):
+        self.idx2Name = {}
+        self.name2Idx = {}
+        self.duplicateNames = {}
+        if listOfDevices != None:
+            for device in listOfDevices:
+                self.Add(getValue(device, "idx", "-1"), getValue(device, "Name"))
+
+    # Add a device
+    def Add(self, idx, name):
+        idx = str(idx)
+        self.idx2Name[idx] = name
+        if name in self.name2Idx and self.name2Idx[name] != idx:
+            if name not in self.duplicateNames:
+                self.duplicateNames[name] = [self.name2Idx[name]]
+            self.duplicateNames[name].append(idx)
+        # Keep last device with a given name
+        self.name2Idx[name] = idx
+
+    # Is an idx known?
+    def __contains__(self, idx):
+        return str(idx) in self.idx2Name
+
+    # Count of known idx
+    def __len__(self):
+        return len(self.idx2Name)
+
+    # Return idx of a device name ("" if not known)
+    def GetIdx(self, name):
+        return self.name2Idx.get(name, "")
+
+    # Return name of a device idx ("" if not known)
+    def GetName(self, idx):
+        return self.idx2Name.get(str(idx), "")
+
+    # Return list of idx using a name if more than one device use it (else None)
+    def GetDuplicates(self, name):
+        return self.duplicateNames.get(name)
+
+# Local synchronized device record base class (slotted, with encoded JSON payloads cached until a field changes)
+class DeviceRecord:
+    __slots__ = ("payload", "compactPayload")
+    fields = ()                     # Fields sent in payload, in this order (fields set to None are not sent)
+
+    # Class initialization: clear all fields, then set given ones
+    def __init__(self, **values):
+        for field in self.fields:
+            object.__setattr__(self, field, None)
+        object.__setattr__(self, "payload", None)
+        object.__setattr__(self, "compactPayload", None)
+        for field, value in values.items():
+            setattr(self, field, value)
+
+    # Set a field, invalidating cached payloads if value changed (master sequence is interned, as shared by all records)
+    def __setattr__(self, field, value):
+        if field == "Sequence" and value != None:
+            value = sys.intern(value)
+        current = getattr(self, field, None)
+        # Same type is also checked, as 1 and True are equal but not encoded the same way
+        if current == value and type(current) == type(value):
+            return
+        object.__setattr__(self, field, value)
+        object.__setattr__(self, "payload", None)
+        object.__setattr__(self, "compactPayload", None)
+
+    # Return fields as a dictionary
+    def AsDict(self):
+        result = {}
+        for field in self.fields:
+            value = getattr(self, field)
+            if value != None:
+                result[field] = value
+        return result
+
+    # Return JSON payload (as UTF-8 bytes, ready to send), encoded only when a field changed since last call
+    def Payload(self):
+        if self.payload == None:
+            object.__setattr__(self, "payload", json.dumps(self.AsDict()).encode("UTF-8"))
+        return self.payload
+
+    # Return compact JSON payload (array of fields in fields order), encoded only when a field changed since last call
+    def CompactPayload(self):
+        if self.compactPayload == None:
+            object.__setattr__(self, "compactPayload", compactJson([getattr(self, field) for field in self.fields]))
+        return self.compactPayload
+
+    # Class default string
+    def __str__(self):
+        return str(self.AsDict())
+
+# Local device values record class (synchronized device values on master)
+class DeviceValues(DeviceRecord):
+    __slots__ = ("allowSlaveUpdate", "nValue", "sValue", "LastUpdate", "Color", "Sequence", "Version")
+    fields = __slots__
+    # allowSlaveUpdate: bool, nValue: int, sValue: str, LastUpdate: str, Color: str, Sequence: str, Version: int
+
+# Local device parameters record class (synchronized device parameters on master)
+class DeviceParameters(DeviceRecord):
+    __slots__ = ("Name", "Type", "SubType", "SwitchType", "Options", "Sequence", "Version")
+    fields = __slots__
+    # Name: str, Type: int, SubType: int, SwitchType: int, Options: str, Sequence: str, Version: int
+
+# Local slave link class (one per slave fed by master, with its own MQTT connection, devices and outbound queue)
+class SlaveLink:
+    name = ""                       # Slave name
+    connectionName = ""             # Slave MQTT connection name
+    rootTopic = ""                  # Root Mqttsync topic of this master/slave pair
+    mqttHost = ""                   # Slave MQTT server address
+    mqttPort = ""                   # Slave MQTT server port
+    mqttUser = ""                   # Slave MQTT username
+    mqttPassword = ""               # Slave MQTT password
+    mqttClient = None               # Slave MQTT client object
+    idxSet = None                   # Idx of devices synchronized with this slave (on master)
+    outbound = None                 # Messages waiting to be sent (key -> (topic, payload, retain)), latest wins on same key
+    burstCount = 0                  # Count of messages sent since last broker ping answer
+    waitingPingResp = False         # Is sending suspended until broker answers ping sent after a burst?
+    burstTime = 0                   # Time of ping sent after last burst
+    lastPublishedValues = None      # Last (nValue, sValue, Color) published per idx
+    lastPublishedTime = None        # Last publish time per idx
+    pendingValues = None            # Idx with values held by minimum interval, to be sent later
+    batchValues = None              # Idx of devices in current batch (dict used as ordered set)
+    batchStartTime = 0              # Time of first device added to current batch
+    snapshotIdxes = None            # Idx sent in batches, with retained values to refresh
+    lastSnapshotTime = 0            # Last refresh time of retained values
+    resyncPending = False           # Is master waiting for slave state before sending changes?
+    resyncRequestTime = 0           # Time of slave state request
+    receivedMessageIds = None       # Message ids of last commands received from slave (dict used as ordered set)
+    compact = False                 # Use compact encoding with this link (supported by other instance)?
+    compress = False                # Compress batch frames sent on this link (supported by other instance)?
+
+    # Class initialization: save parameters
+    def __init__(self, name, mqttHost, mqttPort, mqttUser = None, mqttPassword = None):
+        marker = makeMarker("__init__", "SlaveLink", name, F"{mqttHost}, {mqttPort}, {mqttUser}, {mqttPassword}")
+        self.name = name
+        self.connectionName = F"{variables.slaveConnection}_{name}"
+        self.rootTopic = F"mqttSync/{variables.masterName}2{name}"
+        self.mqttHost = mqttHost
+        self.mqttPort = mqttPort
+        self.mqttUser = mqttUser
+        self.mqttPassword = mqttPassword
+        self.idxSet = set()
+        self.outbound = OrderedDict()
+        self.lastPublishedValues = {}
+        self.lastPublishedTime = {}
+        self.pendingValues = set()
+        self.batchValues = {}
+        self.snapshotIdxes = set()
+        self.receivedMessageIds = OrderedDict()
+
+    # Class default string
+    def __str__(self):
+        return str(self.name)
+
+# Local histogram class (count of observed values by bucket, with fixed bucket upper bounds)
+class Histogram:
+    bounds = None                   # Upper bounds of buckets (an extra last bucket has no upper bound)
+    counts = None                   # Count of values in each bucket
+    count = 0                       # Count of values
+    total = 0                       # Sum of values
+    maximum = 0                     # Maximum value
+
+    # Class initialization: save bounds and clear counts
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.Reset()
+
+    # Clear counts
+    def Reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    # Add a value
+    def Observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    # Return upper bound of bucket containing given percentile (maximum value for last bucket)
+    def Percentile(self, percent):
+        rank = self.count * percent / 100
+        cumulated = 0
+        for bucket, bucketCount in enumerate(self.counts):
+            cumulated += bucketCount
+            if cumulated >= rank and bucketCount:
+                return self.bounds[bucket] if bucket < len(self.bounds) else self.maximum
+        return 0
+
+    # Return summary of values
+    def Summary(self):
+        return {"count": self.count, "mean": self.total / self.count if self.count else 0, "max": self.maximum, \
+            "p50": self.Percentile(50), "p95": self.Percentile(95), "p99": self.Percentile(99), \
+            "buckets": dict(zip([str(bound) for bound in self.bounds] + ["+"], self.counts))}
+
+# Local metrics class (counters and histograms, summarized at regular interval)
+class Metrics:
+    counters = None                 # Counters (name -> value), never reset
+    lastCounters = None             # Counters at last summary
+    histograms = None               # Histograms (name -> Histogram), reset at each summary
+    startTime = 0                   # Time of metrics creation
+    lastTime = 0                    # Time of last summary
+
+    # Class initialization
+    def __init__(self):
+        self.counters = {}
+        self.lastCounters = {}
+        self.histograms = {}
+        self.startTime = time.time()
+        self.lastTime = self.startTime
+
+    # Increment a counter
+    def Count(self, name, increment=1):
+        self.counters[name] = self.counters.get(name, 0) + increment
+
+    # Add a value to an histogram (created with given bounds at first call)
+    def Observe(self, name, value, bounds):
+        histogram = self.histograms.get(name)
+        if histogram == None:
+            histogram = Histogram(bounds)
+            self.histograms[name] = histogram
+        histogram.Observe(value)
+
+    # Return counters (with rates since last summary), gauges and histograms, then reset histograms
+    def Summary(self, gauges):
+        now = time.time()
+        elapsed = max(now - self.lastTime, 0.001)
+        rates = {}
+        for name, value in self.counters.items():
+            rates[name] = round((value - self.lastCounters.get(name, 0)) / elapsed, 3)
+        summary = {"uptime": round(now - self.startTime), "interval": round(elapsed), "counters": dict(self.counters), \
+            "rates": rates, "gauges": gauges, "histograms": {}}
+        for name, histogram in self.histograms.items():
+            summary["histograms"][name] = histogram.Summary()
+            histogram.Reset()
+        self.lastCounters = dict(self.counters)
+        self.lastTime = now
+        return summary
+
+# Local topic router class (finds handler of a received MQTT message from its connection and topic)
+#   Handlers are registered either for an exact topic (called with payload),
+#       or for a topic family, followed by /idx (called with idx and payload)
+#   Routes are built once at startup, and add new topics is just a matter of adding routes
+class TopicRouter:
+    topics = None                   # Exact topic handlers (connection name -> topic -> handler)
+    families = None                 # Topic family handlers (connection name -> topic without /idx -> handler)
+
+    # Class initialization
+    def __init__(self):
+        self.topics = {}
+        self.families = {}
+
+    # Add an exact topic route
+    def AddTopic(self, connectionName, topic, handler):
+        self.topics.setdefault(connectionName, {})[topic] = handler
+
+    # Add a topic family route (topic followed by /idx)
+    def AddFamily(self, connectionName, topic, handler):
+        self.families.setdefault(connectionName, {})[topic] = handler
+
+    # Call handler of a received message, returns False if no route matches
+    def Dispatch(self, connectionName, topic, payload):
+        topics = self.topics.get(connectionName)
+        if topics != None:
+            handler = topics.get(topic)
+            if handler != None:
+                handler(payload)
+                return True
+        families = self.families.get(connectionName)
+        if families != None:
+            family, _, idx = topic.rpartition("/")
+            handler = families.get(family)
+            if handler != None and idx:
+                handler(idx, payload)
+                return True
+        return False
+
+# Local scheduler class (tasks run at heartbeat once due, periodically or only once)
+class Scheduler:
+    heap = None                     # Heap of (due time, sequence, name) entries, entries of rescheduled tasks being skipped
+    tasks = None                    # Scheduled tasks (name -> (due time, interval, function)), interval is 0 for one shot tasks
+    sequence = 0                    # Sequence of last entry added to heap (keeps order of tasks due at same time)
+
+    # Class initialization
+    def __init__(self):
+        self.heap = []
+        self.tasks = {}
+
+    # Schedule a task after a delay, replacing already scheduled one with same name
+    #   When earliest is set, an already scheduled task due before is kept
+    def Add(self, name, delay, function, interval=0, earliest=False):
+        dueTime = time.time() + max(delay, 0)
+        task = self.tasks.get(name)
+        if earliest and task != None and task[0] <= dueTime:
+            return
+        self.Push(name, dueTime, interval, function)
+
+    # Schedule a task at a given time
+    def Push(self, name, dueTime, interval, function):
+        self.tasks[name] = (dueTime, interval, function)
+        self.sequence += 1
+        heapq.heappush(self.heap, (dueTime, self.sequence, name))
+
+    # Remove a task
+    def Cancel(self, name):
+        self.tasks.pop(name, None)
+
+    # Returns due time of a task (None if not scheduled)
+    def DueTime(self, name):
+        task = self.tasks.get(name)
+        return task[0] if task != None else None
+
+    # Run tasks due at given time, rescheduling periodic ones (tasks scheduled while running will run next time)
+    def RunDue(self, now):
+        dueTasks = []
+        while self.heap and self.heap[0][0] <= now:
+            dueTime, sequence, name = heapq.heappop(self.heap)
+            task = self.tasks.get(name)
+            if task == None or task[0] != dueTime:
+                continue
+            dueTime, interval, function = task
+            if interval > 0:
+                # Missed periods are skipped
+                self.Push(name, dueTime + interval if dueTime + interval > now else now + interval, interval, function)
+            else:
+                del self.tasks[name]
+            dueTasks.append(function)
+        for function in dueTasks:
+            function()
+
+    # Returns delay until next task (None if nothing scheduled)
+    def NextDelay(self, now):
+        while self.heap:
+            dueTime, sequence, name = self.heap[0]
+            task = self.tasks.get(name)
+            if task != None and task[0] == dueTime:
+                return max(dueTime - now, 0)
+            heapq.heappop(self.heap)
+        return None
+
 ####    Plug-in code    ####
 
 # Compose a marker to display in front of each message
 #   Optionally, add a debug line, still optionally with parameters)
+#   Markers are cached, and parameters may be given as a callable, evaluated only when debugging
 def makeMarker(function, module="", instance="", parameters="", ignore=False):
-    # Start with module
-    marker = module
-    # Add instance if not empty
-    if instance !="":
-        # Add "/" separator if module not empty
+    key = (function, module, instance)
+    marker = variables.markerCache.get(key)
+    if marker == None:
+        # Start with module
+        marker = module
+        # Add instance if not empty
+        if instance !="":
+            # Add "/" separator if module not empty
+            if marker != "":
+                marker += "/"
+            # Add instance
+            marker += instance
+        # If module and/or instance given, add "::"
         if marker != "":
-            marker += "/"
-        # Add instance
-        marker += instance
-    # If module and/or instance given, add "::"
-    if marker != "":
-        marker += "::"
-    # Terminate by function and ":"
-    marker += function + ":"
-    # Send a debug message if not marked to be ingored
-    if not ignore:
+            marker += "::"
+        # Terminate by function and ":"
+        marker += function + ":"
+        variables.markerCache[key] = marker
+    # Send a debug message if debugging and not marked to be ingored
+    if variables.debugEnabled and not ignore:
+        if callable(parameters):
+            parameters = parameters()
         # Add marker and paramaters
         Domoticz.Debug((marker+" "+parameters).strip())
     return marker
@@ -233,37 +972,70 @@ def getValue(dict, key, default=''):
         else:
             return default
 
+# Encode values as compact JSON (array without spaces, trailing unset values removed)
+def compactJson(values):
+    while values and values[-1] == None:
+        values.pop()
+    return json.dumps(values, separators=(",", ":")).encode("UTF-8")
+
+# Convert a compact array into a dictionary, given its fields (unset fields are not returned)
+def compactToDict(values, fields):
+    return {field: value for field, value in zip(fields, values) if value != None}
+
+# Decode a JSON payload, either an object or a compact array of given fields
+def decodePayload(payload, fields):
+    jsonPayload = json.loads(payload)
+    if type(jsonPayload) == list:
+        return compactToDict(jsonPayload, fields)
+    return jsonPayload
+
+# Return (cached) payload of a device record, encoded as supported by slave of a link
+def encodeRecord(link, record):
+    return record.CompactPayload() if link.compact else record.Payload()
+
+# Return payload of a slave command, encoded as supported by master
+def encodeCommand(link, fields):
+    if link.compact:
+        return compactJson([fields.get(field) for field in variables.commandFields])
+    return json.dumps(fields).encode("UTF-8")
+
 # Load name -> IDX correspondance table from list of devices
 def loadName2Idx(listOfDevices):
     marker = makeMarker("loadName2Idx")
-    variables.name2Idx = {}
-    variables.idxList = []
-    for device in listOfDevices:
-        variables.name2Idx[getValue(device,"Name")] = getValue(device, "idx", "-1")
-        variables.idxList.append(getValue(device, "idx", "-1"))
-    Domoticz.Log(F"{marker} {len(variables.idxList)} idx and {len(variables.name2Idx)} names loaded")
+    variables.deviceCatalog = DeviceCatalog(listOfDevices)
+    Domoticz.Log(F"{marker} {len(variables.deviceCatalog)} idx and {len(variables.deviceCatalog.name2Idx)} names loaded" \
+        +F", {len(variables.deviceCatalog.duplicateNames)} names used by multiple devices")
 
 # Read mapping data and create synchronized devices dictionary
 def loadMapping(mappingData):
     marker = makeMarker("loadMapping")
-    # Clear dictionary
+    # Clear dictionaries (keeping values already known, restored from saved state)
+    previousDevices = variables.syncDevices
     variables.syncDevices = {}
+    variables.publishFilters = {}
+    for link in variables.slaveLinks:
+        link.idxSet = set()
     # Read all lines
     for item in mappingData:
-        Domoticz.Debug(F"{marker} Analyzing {item}")
+        if variables.debugEnabled:
+            Domoticz.Debug(F"{marker} Analyzing {item}")
         # Load item IDX
         itemIdx = str(getValue(item, "idx"))
         # Does item have a name element?
         itemName = getValue(item,"name")
         if itemName != "":
             # Find idx from name
-            itemIdx2 = str(getValue(variables.name2Idx, itemName))
+            itemIdx2 = variables.deviceCatalog.GetIdx(itemName)
             # Idx corresponding to name found
             if itemIdx2 != "":
+                duplicates = variables.deviceCatalog.GetDuplicates(itemName)
                 # Do we also have idx specified in item?
                 if itemIdx != "":
-                    if itemIdx != itemIdx2:
-                        Domoticz.Error(F"{marker} {itemName} idx is {itemIdx2} but {itemIdx} also specified in {str(item)} - Keeping idx {itemIdx}")
+                    if itemIdx != itemIdx2 and (duplicates == None or itemIdx not in duplicates):
+                        Domoticz.Error(F"{marker} {itemName} idx is {itemIdx2} but {itemIdx} (named {variables.deviceCatalog.GetName(itemIdx)}) also specified in {str(item)} - Keeping idx {itemIdx}")
+                elif duplicates != None:
+                    Domoticz.Error(F"{marker} {itemName} is used by idx {duplicates} for {str(item)} - Using idx {itemIdx2}, specify idx to select another one")
+                    itemIdx = itemIdx2
                 else:
                     # Set idx from name
                     itemIdx = itemIdx2
@@ -274,17 +1046,61 @@ def loadMapping(mappingData):
                 else:
                     Domoticz.Error(F"{marker} Can't find >{itemName}< for {str(item)} - Line ignored!!")
         if itemIdx != "":
-            if itemIdx in variables.idxList:
-                deviceParams = {}
-                deviceParams['allowSlaveUpdate'] = bool(getValue(item, 'allowSlaveUpdate', 'False'))
-                variables.syncDevices[itemIdx] = deviceParams
+            if itemIdx in variables.deviceCatalog:
+                allowSlaveUpdate = bool(getValue(item, 'allowSlaveUpdate', 'False'))
+                fields = previousDevices.get(itemIdx)
+                if fields == None:
+                    fields = DeviceValues(allowSlaveUpdate=allowSlaveUpdate)
+                elif fields.allowSlaveUpdate != allowSlaveUpdate:
+                    fields.allowSlaveUpdate = allowSlaveUpdate
+                    fields.Version = nextVersion()
+                variables.syncDevices[itemIdx] = fields
+                loadPublishFilter(itemIdx, item)
+                loadItemSlaves(itemIdx, item)
             else:
-                Domoticz.Debug(F"{marker} idxList: {variables.idxList}")
                 Domoticz.Error(F"{marker} Device idx {itemIdx} is not known for {str(item)} - Line ignored!!")
         else:
             Domoticz.Error(F"{marker} No idx found for {str(item)} - Line ignored!!")
-    for line in variables.syncDevices:
-        Domoticz.Debug(F"{marker} Result: {line} {variables.syncDevices[line]}")
+    # Forget parameters of devices no longer synchronized
+    variables.syncParameters = {idx: fields for idx, fields in variables.syncParameters.items() if idx in variables.syncDevices}
+    if variables.debugEnabled:
+        for line in variables.syncDevices:
+            Domoticz.Debug(F"{marker} Result: {line} {variables.syncDevices[line]}")
+
+# Load publish filter of a mapping item
+def loadPublishFilter(idx, item):
+    marker = makeMarker("loadPublishFilter")
+    mode = getValue(item, "publish", "always")
+    if mode == "always":
+        return
+    if mode not in ("onChange", "deadband", "interval"):
+        Domoticz.Error(F"{marker} Unknown publish mode {mode} for {str(item)} - Using 'always'")
+        return
+    publishFilter = {"mode": mode}
+    try:
+        publishFilter["deadband"] = float(getValue(item, "deadband", 0))
+        publishFilter["minInterval"] = float(getValue(item, "minInterval", 0))
+    except ValueError as e:
+        Domoticz.Error(F"{marker} {e} for {str(item)} - Using 'always'")
+        return
+    variables.publishFilters[idx] = publishFilter
+
+# Add a mapping item to slaves it should be synchronized with (all slaves if not specified)
+def loadItemSlaves(idx, item):
+    marker = makeMarker("loadItemSlaves")
+    slaveNames = getValue(item, "slaves", None)
+    if slaveNames == None:
+        for link in variables.slaveLinks:
+            link.idxSet.add(idx)
+        return
+    if type(slaveNames).__name__ != "list":
+        slaveNames = [slaveNames]
+    for slaveName in slaveNames:
+        link = variables.slaveLinkByName.get(slaveName)
+        if link != None:
+            link.idxSet.add(idx)
+        else:
+            Domoticz.Error(F"{marker} Unknown slave {slaveName} for {str(item)} - Ignored")
 
 # Dump plug-in configuration to log
 def DumpConfigToLog():
@@ -324,12 +1140,41 @@ def DumpHTTPResponseToLog(httpResp, level=0):
 def replaceCrLf(message):
     return str(message).replace("\r","\\r").replace("\n","\\n")
 
+# Build DeviceID -> Unit index from existing devices
+def buildDeviceIndex():
+    marker = makeMarker("buildDeviceIndex")
+    variables.deviceId2Unit = {}
+    variables.unit2DeviceId = {}
+    for unit in Devices:
+        indexDevice(unit)
+    Domoticz.Debug(F"{marker} {len(variables.deviceId2Unit)} devices indexed")
+
+# Add (or refresh) a device in DeviceID index
+def indexDevice(unit):
+    if unit in Devices:
+        deviceId = str(Devices[unit].DeviceID)
+        # Remove previous DeviceID of this unit, if changed
+        oldDeviceId = variables.unit2DeviceId.get(unit)
+        if oldDeviceId != None and oldDeviceId != deviceId and variables.deviceId2Unit.get(oldDeviceId) == unit:
+            del variables.deviceId2Unit[oldDeviceId]
+        variables.deviceId2Unit[deviceId] = unit
+        variables.unit2DeviceId[unit] = deviceId
+
+# Remove a device from DeviceID index
+def unindexDevice(unit):
+    deviceId = variables.unit2DeviceId.pop(unit, None)
+    if deviceId != None and variables.deviceId2Unit.get(deviceId) == unit:
+        del variables.deviceId2Unit[deviceId]
+
 # Find a device by key in devices table
 def getDevice(deviceKey):
-    for device in Devices:
-        if (str(Devices[device].DeviceID) == str(deviceKey)) :
-            # Return device
-            return Devices[device]
+    deviceKey = str(deviceKey)
+    unit = variables.deviceId2Unit.get(deviceKey)
+    if unit != None and unit in Devices:
+        device = Devices[unit]
+        # Make sure index is not stale
+        if str(device.DeviceID) == deviceKey:
+            return device
     # Return None if not found
     return None
 
@@ -340,23 +1185,49 @@ def deviceStr(unit):
         name = Devices[unit].Name
     return name
 
-# Get next free device Id
-def getNextDeviceId():
-    nextDeviceId = 1
-    while True:
-        exists = False
-        for device in Devices:
-            if (device == nextDeviceId) :
-                exists = True
-                break
-        if (not exists):
-            break;
-        nextDeviceId = nextDeviceId + 1
-    return nextDeviceId
-
-# Decode options fields (as some fields are base64 encoded)
-def decodeOptions(options):
-    marker = makeMarker("decodedOptions", parameters=F"{options}")
+# Build free units list from existing devices
+def buildFreeUnits():
+    marker = makeMarker("buildFreeUnits")
+    highestUnit = max(Devices.keys(), default=0)
+    # Holes below highest used unit are free, sorted list is a valid heap
+    variables.freeUnits = [unit for unit in range(1, highestUnit) if unit not in Devices]
+    variables.freeUnitsSet = set(variables.freeUnits)
+    variables.nextFreeUnit = highestUnit + 1
+    Domoticz.Debug(F"{marker} {len(variables.freeUnits)} free units below {variables.nextFreeUnit}")
+
+# Get next free device unit
+def allocateUnit():
+    # Reuse lowest released unit first (skipping units used in between)
+    while variables.freeUnits:
+        unit = heapq.heappop(variables.freeUnits)
+        if unit in variables.freeUnitsSet:
+            variables.freeUnitsSet.discard(unit)
+            if unit not in Devices:
+                return unit
+    # Else, take next unit above highest one
+    while variables.nextFreeUnit in Devices:
+        variables.nextFreeUnit += 1
+    unit = variables.nextFreeUnit
+    variables.nextFreeUnit += 1
+    return unit
+
+# Give a device unit back to free units
+def releaseUnit(unit):
+    if unit < variables.nextFreeUnit and unit not in variables.freeUnitsSet:
+        variables.freeUnitsSet.add(unit)
+        heapq.heappush(variables.freeUnits, unit)
+
+# Remove a device unit from free units (device created outside allocator)
+def claimUnit(unit):
+    variables.freeUnitsSet.discard(unit)
+    if unit >= variables.nextFreeUnit:
+        variables.nextFreeUnit = unit + 1
+
+# Decode options fields (as some fields are base64 encoded), returning an immutable dictionary
+#   Last decoded options are cached, as same options are received again at each resync
+@functools.lru_cache(maxsize=256)
+def getDecodedOptions(options):
+    marker = makeMarker("getDecodedOptions", parameters=lambda: F"{options}")
     # Create options dictionary
     decodedOptions = {}
     # If they're some options
@@ -372,14 +1243,20 @@ def decodeOptions(options):
             # Value is second, base64 encoded
             value = base64.b64decode(parts[1]).decode("UTF-8")
             decodedOptions[key] = value
-    Domoticz.Debug(F"{marker} Decoded {str(decodedOptions)}")
-    return decodedOptions
+    if variables.debugEnabled:
+        Domoticz.Debug(F"{marker} Decoded {str(decodedOptions)}")
+    return MappingProxyType(decodedOptions)
+
+# Decode options fields, returning a (modifiable) dictionary, as expected by Domoticz
+def decodeOptions(options):
+    return dict(getDecodedOptions(options))
 
 # Load settings
 def loadSettings():
     marker = makeMarker("loadSettings")
     # Parse options
     variables.debugging = Parameters["Mode6"]        # Debug mode from plug-in parameters
+    variables.debugEnabled = variables.debugging in ("Verbose+", "Verbose", "Debug")
     DumpConfigToLog()
     if variables.debugging == "Verbose+":
         Domoticz.Debugging(1+2+4+8+16+32+64+128)
@@ -427,6 +1304,24 @@ def loadSettings():
                 inError = True
             variables.masterMqttUser = getValue(variables.settings, "masterMqttUser")
             variables.masterMqttPassword = getValue(variables.settings, "masterMqttPassword")
+            # Get source of device definitions
+            variables.definitionsSource = getValue(variables.settings, "definitionsSource", "auto")
+            if variables.definitionsSource not in ("auto", "database", "backup"):
+                Domoticz.Error(F"{marker} 'settings/definitionsSource' should be 'auto', 'database' or 'backup' in {jsonFile}")
+                inError = True
+            # Get batch settings (batch disabled if window is zero)
+            try:
+                variables.batchWindow = float(getValue(variables.settings, "batchWindow", 0))
+                variables.snapshotInterval = float(getValue(variables.settings, "snapshotInterval", 60))
+            except ValueError as e:
+                Domoticz.Error(F"{marker} {e} when loading 'settings/batchWindow' or 'settings/snapshotInterval' in {jsonFile}")
+                inError = True
+            # Get state save interval (no warm start if zero)
+            try:
+                variables.stateSaveInterval = float(getValue(variables.settings, "stateSaveInterval", 60))
+            except ValueError as e:
+                Domoticz.Error(F"{marker} {e} when loading 'settings/stateSaveInterval' in {jsonFile}")
+                inError = True
             # Get mapping part
             variables.mapping = getValue(jsonData, "mapping")
             if not variables.mapping:
@@ -443,23 +1338,81 @@ def loadSettings():
             Domoticz.Error(F"{marker} Can't find 'settings/masterName' in {jsonFile}")
             inError = True
 
-        variables.slaveName = getValue(variables.settings, "slaveName")
-        if not variables.slaveName:
-            Domoticz.Error(F"{marker} Can't find 'settings/slaveName' in {jsonFile}")
+        # Get settings for Slave(s) MQTT, either given in 'settings/slaves' list, or directly in 'settings' for one slave
+        slavesSettings = getValue(variables.settings, "slaves", None)
+        settingsPath = "settings/slaves"
+        if slavesSettings == None:
+            slavesSettings = [variables.settings]
+            settingsPath = "settings"
+        elif not variables.areWeOnMaster:
+            # On slave, only keep our slave (given by 'settings/slaveName' if more than one slave)
+            ourName = getValue(variables.settings, "slaveName")
+            if ourName:
+                slavesSettings = [slave for slave in slavesSettings if getValue(slave, "slaveName") == ourName]
+            if len(slavesSettings) != 1:
+                Domoticz.Error(F"{marker} Can't find slave >{ourName}< in 'settings/slaves' in {jsonFile}")
+                inError = True
+        variables.slaveLinks = []
+        variables.slaveLinkByName = {}
+        variables.slaveLinkByConnection = {}
+        for slaveSettings in slavesSettings:
+            slaveName = getValue(slaveSettings, "slaveName")
+            if not slaveName:
+                Domoticz.Error(F"{marker} Can't find '{settingsPath}/slaveName' in {jsonFile}")
+                inError = True
+                continue
+            if slaveName in variables.slaveLinkByName:
+                Domoticz.Error(F"{marker} Slave {slaveName} defined more than once in {jsonFile}")
+                inError = True
+                continue
+            slaveMqttHost = getValue(slaveSettings, "slaveMqttHost")
+            if not slaveMqttHost:
+                Domoticz.Error(F"{marker} Can't find '{settingsPath}/slaveMqttHost' for slave {slaveName} in {jsonFile}")
+                inError = True
+            slaveMqttPort = getValue(slaveSettings, "slaveMqttPort")
+            if not slaveMqttPort:
+                Domoticz.Error(F"{marker} Can't find '{settingsPath}/slaveMqttPort' for slave {slaveName} in {jsonFile}")
+                inError = True
+            link = SlaveLink(slaveName, slaveMqttHost, slaveMqttPort, \
+                getValue(slaveSettings, "slaveMqttUser"), getValue(slaveSettings, "slaveMqttPassword"))
+            variables.slaveLinks.append(link)
+            variables.slaveLinkByName[slaveName] = link
+            variables.slaveLinkByConnection[link.connectionName] = link
+        if not variables.slaveLinks:
+            Domoticz.Error(F"{marker} No slave defined in {jsonFile}")
+            inError = True
+
+        # Log each received MQTT message only if asked for
+        variables.logMqttMessages = bool(getValue(variables.settings, "logMqttMessages", False))
+
+        # Get stats settings (stats not published if interval is zero)
+        try:
+            variables.statsInterval = float(getValue(variables.settings, "statsInterval", 60))
+        except ValueError as e:
+            Domoticz.Error(F"{marker} {e} when loading 'settings/statsInterval' in {jsonFile}")
             inError = True
+        variables.statsDevices = bool(getValue(variables.settings, "statsDevices", False))
+
+        # Use compact encoding (if supported by other instance)?
+        variables.compactEncoding = bool(getValue(variables.settings, "compactEncoding", False))
 
-        # Get settings for Slave MQTT
-        variables.slaveMqttHost = getValue(variables.settings, "slaveMqttHost")
-        if not variables.slaveMqttHost:
-            Domoticz.Error(F"{marker} Can't find 'settings/slaveMqttHost' in {jsonFile}")
+        # Get QoS of slave commands (given on both instances)
+        try:
+            variables.commandQos = int(getValue(variables.settings, "commandQos", 0))
+        except ValueError as e:
+            Domoticz.Error(F"{marker} {e} when loading 'settings/commandQos' in {jsonFile}")
             inError = True
-        variables.slaveMqttPort = getValue(variables.settings, "slaveMqttPort")
-        if not variables.slaveMqttPort:
-            Domoticz.Error(F"{marker} Can't find 'settings/slaveMqttPort' in {jsonFile}")
+        if variables.commandQos not in (0, 1):
+            Domoticz.Error(F"{marker} 'settings/commandQos' should be 0 or 1 in {jsonFile}")
             inError = True
 
-        variables.slaveMqttUser = getValue(variables.settings, "slaveMqttUser")
-        variables.slaveMqttPassword = getValue(variables.settings, "slaveMqttPassword")
+        # Get command rate limit by device (given on both instances)
+        try:
+            variables.commandRate = float(getValue(variables.settings, "commandRate", 0))
+            variables.commandBurst = int(getValue(variables.settings, "commandBurst", 2))
+        except ValueError as e:
+            Domoticz.Error(F"{marker} {e} when loading 'settings/commandRate' or 'settings/commandBurst' in {jsonFile}")
+            inError = True
 
         # Exit if something not found
         if inError :
@@ -474,13 +1427,51 @@ def loadSettings():
         variables.domoticzHttps = urlParts.scheme.lower() == "https"
 
         # Compose other variables
-        variables.rootTopic = F"mqttSync/{variables.masterName}2{variables.slaveName}"
+        # Master MQTT topics are shared by all slaves (unchanged topics when only one slave)
+        if len(variables.slaveLinks) == 1:
+            variables.rootTopic = variables.slaveLinks[0].rootTopic
+        else:
+            variables.rootTopic = F"mqttSync/{variables.masterName}"
         variables.databaseCopyFileName = os.path.join(Parameters['HomeFolder'], "databaseCopy.db")
+        variables.parametersFingerprintsFileName = os.path.join(Parameters['HomeFolder'], \
+            F"{variables.masterName}2{variables.slaveLinks[0].name}.fingerprints.json")
+        variables.slaveCacheFileName = os.path.join(Parameters['HomeFolder'], \
+            F"{variables.masterName}2{variables.slaveLinks[0].name}.cache.json")
+        variables.stateFileName = os.path.join(Parameters['HomeFolder'], F"{variables.masterName}.state.json")
         variables.masterSequence = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         variables.slaveSequence = variables.masterSequence
+        buildRouting()
 
     variables.initDone = True
 
+# Build connection message handlers and MQTT topic routes
+def buildRouting():
+    variables.messageHandlers = {}
+    variables.topicRouter = TopicRouter()
+    if variables.areWeOnMaster:
+        variables.messageHandlers[variables.name2IdxConnection] = onHttpName2IdxMessage
+        variables.messageHandlers[variables.backupDatabaseConnection] = onHttpBackupDatabaseMessage
+        variables.messageHandlers[variables.sendSlaveUpdateConnection] = onSendSlaveUpdateMessage
+        variables.messageHandlers[variables.masterConnection] = onMqttMessage
+        variables.topicRouter.AddTopic(variables.masterConnection, variables.domoticzOutTopic, onMasterReceived)
+    for link in variables.slaveLinks:
+        variables.messageHandlers[link.connectionName] = onMqttMessage
+        if variables.compactEncoding:
+            variables.topicRouter.AddTopic(link.connectionName, F"{link.rootTopic}/lwt/" \
+                +("slaveOnSlave" if variables.areWeOnMaster else "slaveOnMaster"), functools.partial(onPeerLwtReceived, link))
+        if variables.areWeOnMaster:
+            variables.topicRouter.AddFamily(link.connectionName, F"{link.rootTopic}/{variables.slaveValues}", \
+                functools.partial(onSlaveValuesReceived, link))
+            variables.topicRouter.AddTopic(link.connectionName, F"{link.rootTopic}/{variables.slaveState}", \
+                functools.partial(onSlaveStateReceived, link))
+        else:
+            variables.topicRouter.AddFamily(link.connectionName, F"{link.rootTopic}/{variables.masterParameters}", \
+                onMasterParametersReceived)
+            variables.topicRouter.AddFamily(link.connectionName, F"{link.rootTopic}/{variables.masterValues}", \
+                onMasterValuesReceived)
+            variables.topicRouter.AddTopic(link.connectionName, F"{link.rootTopic}/{variables.masterBatch}", \
+                onMasterBatchReceived)
+
 # Connect to MQTT master
 def connectToMqttMaster():
     marker = makeMarker("connectToMqttMaster")
@@ -492,127 +1483,513 @@ def connectToMqttMaster():
     variables.masterMqttClient = MqttClient(variables.masterConnection, variables.masterMqttHost, variables.masterMqttPort, \
         variables.masterMqttUser, variables.masterMqttPassword, lwtTopic, json.dumps(lwtData))
     variables.masterMqttClient.Open()
+    scheduleKeepAlive()
 
 # Connect to MQTT slave from Master
-def connectToMqttSlaveOnMaster():
-    marker = makeMarker("connectToMqttSlaveOnMaster")
+def connectToMqttSlaveOnMaster(link):
+    marker = makeMarker("connectToMqttSlaveOnMaster", instance=link.name)
     # Connect to slave MQTT server
-    lwtTopic = F"{variables.rootTopic}/lwt/slaveOnMaster"
+    lwtTopic = F"{link.rootTopic}/lwt/slaveOnMaster"
     lwtData = {}
     lwtData["state"] = "down"
     lwtData["version"] =  variables.pluginVersion
-    variables.slaveMqttClient = MqttClient(variables.slaveConnection, variables.slaveMqttHost, variables.slaveMqttPort, \
-        variables.slaveMqttUser, variables.slaveMqttPassword, lwtTopic, json.dumps(lwtData))
-    variables.slaveMqttClient.Open()
+    link.mqttClient = MqttClient(link.connectionName, link.mqttHost, link.mqttPort, \
+        link.mqttUser, link.mqttPassword, lwtTopic, json.dumps(lwtData))
+    link.mqttClient.Open()
+    scheduleKeepAlive()
 
 # Connect to MQTT slave from Slave
-def connectToMqttSlaveOnSlave():
-    marker = makeMarker("connectToMqttSlaveOnSlave")
+def connectToMqttSlaveOnSlave(link):
+    marker = makeMarker("connectToMqttSlaveOnSlave", instance=link.name)
     # Connect to slave MQTT server
-    lwtTopic = F"{variables.rootTopic}/lwt/slaveOnSlave"
+    lwtTopic = F"{link.rootTopic}/lwt/slaveOnSlave"
     lwtData = {}
     lwtData["state"] = "down"
     lwtData["version"] =  variables.pluginVersion
-    variables.slaveMqttClient = MqttClient(variables.slaveConnection, variables.slaveMqttHost, variables.slaveMqttPort, \
-        variables.slaveMqttUser, variables.slaveMqttPassword, lwtTopic, json.dumps(lwtData))
-    variables.slaveMqttClient.Open()
+    link.mqttClient = MqttClient(link.connectionName, link.mqttHost, link.mqttPort, \
+        link.mqttUser, link.mqttPassword, lwtTopic, json.dumps(lwtData))
+    link.mqttClient.Open()
+    scheduleKeepAlive()
+
+# Returns MQTT clients (master and slaves) already created
+def getMqttClients():
+    clients = [link.mqttClient for link in variables.slaveLinks if link.mqttClient != None]
+    if variables.masterMqttClient != None:
+        clients.append(variables.masterMqttClient)
+    return clients
+
+# Returns MQTT client of a connection name (None if not found)
+def getMqttClient(connectionName):
+    if connectionName == variables.masterConnection:
+        return variables.masterMqttClient
+    link = variables.slaveLinkByConnection.get(connectionName)
+    return link.mqttClient if link != None else None
+
+# Keep MQTT connections alive (ping idle ones, reopen closed ones), then schedule next check
+def keepMqttAlive():
+    now = time.time()
+    for client in getMqttClients():
+        client.KeepAlive(now)
+    scheduleKeepAlive()
+
+# Schedule next MQTT keep alive check, when first connection will be idle for a ping interval or could be reopened
+def scheduleKeepAlive():
+    nextTimes = [client.NextKeepAliveTime() for client in getMqttClients()]
+    if nextTimes:
+        # Don't check again before one second (a connection may stay in connecting state)
+        scheduleTask("keepAlive", max(min(nextTimes) - time.time(), 1), keepMqttAlive)
+
+# Schedule a task, and make heartbeat fast enough to run it on time
+def scheduleTask(name, delay, function, interval=0, earliest=False):
+    variables.scheduler.Add(name, delay, function, interval, earliest)
+    setHeartbeat()
+
+# Set heartbeat interval to delay until next scheduled task (between 1 and 30 seconds, Domoticz limits)
+def setHeartbeat():
+    delay = variables.scheduler.NextDelay(time.time())
+    interval = variables.maxHeartbeat if delay == None else max(1, min(variables.maxHeartbeat, math.ceil(delay)))
+    if interval != variables.heartbeatInterval:
+        variables.heartbeatInterval = interval
+        Domoticz.Heartbeat(interval)
+
+# Read synchronized devices rows from database, by slices to stay below SQLite variables limit
+def readSyncDeviceRows(cursor):
+    idxList = [int(idx) for idx in variables.syncDevices.keys() if idx.isdigit()]
+    for start in range(0, len(idxList), variables.sqlMaxVariables):
+        idxSlice = idxList[start:start+variables.sqlMaxVariables]
+        cursor.execute('select ID, Type, SubType, SwitchType, nValue, sValue, Options, LastUpdate, Color, Name from DeviceStatus' \
+            +' where ID in (' + ','.join('?' * len(idxSlice)) + ')', idxSlice)
+        #          Field #:       0    1      2         3          4       5       6          7         8     9
+        for row in cursor:
+            yield row
 
 # Load device definition from database copy
+#   Parameters and values restored from saved state are only sent again to slaves when changed
 def loadDefinitionsFromDb():
     marker = makeMarker("loadDefinitionsFromDb")
     if variables.databaseConnecion != None:
         cursor = variables.databaseConnecion.cursor()
-        result = cursor.execute('select ID, Type, SubType, SwitchType, nValue, sValue, Options, LastUpdate, Color, Name from DeviceStatus')
-        #          Field #:              0    1      2         3          4       5       6          7         8     9
-        for row in result.fetchall():
+        changedCount = 0
+        for row in readSyncDeviceRows(cursor):
             idx = str(row[0])
             if idx in variables.syncDevices.keys():
                 # Load parameters topics
-                fields = {}
-                fields["Name"] = row[9]
-                fields['Type'] = row[1]
-                fields['SubType'] = row[2]
-                fields['SwitchType'] = row[3]
+                fields = DeviceParameters(Name=row[9], Type=row[1], SubType=row[2], SwitchType=row[3])
                 if row[6] != None:
-                    fields['Options'] = row[6]
-                fields['Sequence'] = variables.masterSequence
-                # Save parameters
-                variables.syncParameters[idx] = fields
-                Domoticz.Debug(F"{marker} syncParameters={idx}:{fields}")
+                    fields.Options = row[6]
+                    # Report options that slave may not be able to decode (they are sent anyway)
+                    try:
+                        getDecodedOptions(row[6])
+                    except (ValueError, IndexError) as e:
+                        Domoticz.Error(F"{marker} {e} when decoding idx {idx} options >{row[6]}<")
+                previous = variables.syncParameters.get(idx)
+                parametersChanged = previous == None or previous.Name != fields.Name or previous.Type != fields.Type \
+                    or previous.SubType != fields.SubType or previous.SwitchType != fields.SwitchType or previous.Options != fields.Options
+                if parametersChanged:
+                    fields.Sequence = variables.masterSequence
+                    fields.Version = nextVersion()
+                    # Save parameters
+                    variables.syncParameters[idx] = fields
+                    if variables.debugEnabled:
+                        Domoticz.Debug(F"{marker} syncParameters={idx}:{fields}")
                 # Load/update values topics
                 fields = variables.syncDevices[idx]
-                if "nValue" not in fields:
-                    fields['nValue'] = row[4]
-                if "sValue" not in fields:
-                    fields['sValue'] = row[5]
-                if "LastUpdate" not in fields:
-                    fields['LastUpdate'] = row[7]
-                if "Color" not in fields and row[8] != None and row[8] != "":
-                    fields["Color"] = row[8]
-                fields['Sequence'] = variables.masterSequence
-                # Save last values
-                variables.syncDevices[idx] = fields
-                Domoticz.Debug(F"{marker} syncDevices={idx}:{fields}")
-                # Send updates if slave mqtt connected
-                if variables.slaveMqttClient != None:
-                    variables.slaveMqttClient.Publish(F"{variables.rootTopic}/{variables.masterValues}/{idx}", json.dumps(fields), retain=1)
-        connectToMqttSlaveOnMaster()
-
-# Send next slave update
-def sendNextSlaveUpdate():
-    marker = makeMarker("sendNextSlaveUpdate", parameters=F"Queue length={len(variables.sendApiUpdateList)}")
-    # Is queue empty?
-    if len(variables.sendApiUpdateList) == 0:
-        # Yes, close connection
-        variables.httpClient = None
-    else:
-        # No, check for client
-        if variables.httpClient != None:
-            # Client exists, is it connected?
-            if variables.httpClient.connection.Connected():
-                # Send next slave update 
-                sendSlaveUpdate(variables.httpClient.connection)
-            else:
-                # Client exists, not connected
-                prepareSendingSlaveUpdate()
+                color = row[8] if row[8] != "" else None
+                if (fields.Version or 0) <= variables.restoredVersion:
+                    # Values not received from domoticz/out since start, take database ones if different
+                    valuesChanged = fields.nValue != row[4] or fields.sValue != row[5] or fields.Color != color
+                    if valuesChanged:
+                        fields.nValue = row[4]
+                        fields.sValue = row[5]
+                        fields.LastUpdate = row[7]
+                        fields.Color = color
+                else:
+                    # Keep values received from domoticz/out, only completing them
+                    valuesChanged = fields.LastUpdate == None or (fields.Color == None and color != None)
+                    if fields.LastUpdate == None:
+                        fields.LastUpdate = row[7]
+                    if fields.Color == None and color != None:
+                        fields.Color = color
+                valuesChanged = valuesChanged or fields.Sequence == None
+                if valuesChanged:
+                    fields.Sequence = variables.masterSequence
+                    fields.Version = nextVersion()
+                    if variables.debugEnabled:
+                        Domoticz.Debug(F"{marker} syncDevices={idx}:{fields}")
+                if parametersChanged or valuesChanged:
+                    changedCount += 1
+                    # Send updates to connected slaves using this device
+                    for link in variables.slaveLinks:
+                        if idx in link.idxSet:
+                            if parametersChanged:
+                                publishMasterParameters(link, idx)
+                            if valuesChanged:
+                                publishMasterSnapshot(link, idx)
+        if variables.restoredVersion:
+            Domoticz.Log(F"{marker} {changedCount} devices changed since saved state")
+        # Slaves are already connected when state was restored
+        for link in variables.slaveLinks:
+            if link.mqttClient == None:
+                connectToMqttSlaveOnMaster(link)
+        saveMasterState()
+
+# Save master state (device catalog, parameters and values of synchronized devices), if changed since last save
+#   A clean state (saved at stop) contains all versions given by this run, so next run can keep master sequence
+def saveMasterState(clean=False):
+    marker = makeMarker("saveMasterState", parameters=lambda: F"clean {clean}")
+    # Nothing to save before device definitions are loaded (or restored)
+    if variables.stateSaveInterval <= 0 or variables.deviceCatalog == None or not variables.syncParameters:
+        return
+    if variables.versionCounter == variables.savedStateVersion and not clean:
+        return
+    state = {"Sequence": variables.masterSequence, "Version": variables.versionCounter, "Clean": clean, \
+        "Catalog": variables.deviceCatalog.idx2Name, \
+        "Parameters": {idx: fields.AsDict() for idx, fields in variables.syncParameters.items()}, \
+        "Values": {idx: fields.AsDict() for idx, fields in variables.syncDevices.items() if fields.Sequence != None}}
+    try:
+        with open(variables.stateFileName + ".tmp", "w", encoding = 'UTF-8') as stateStream:
+            json.dump(state, stateStream)
+        os.replace(variables.stateFileName + ".tmp", variables.stateFileName)
+        variables.savedStateVersion = variables.versionCounter
+        Domoticz.Debug(F"{marker} {len(state['Parameters'])} devices saved up to version {variables.versionCounter}")
+    except Exception as e:
+        Domoticz.Error(F"{marker} {e} when saving {variables.stateFileName}")
+
+# Restore master state saved by previous run, to serve slaves before device definitions are read again
+#   Returns True if state has been restored
+def loadMasterState():
+    marker = makeMarker("loadMasterState")
+    if variables.stateSaveInterval <= 0:
+        return False
+    try:
+        with open(variables.stateFileName, encoding = 'UTF-8') as stateStream:
+            state = json.load(stateStream)
+        catalog = DeviceCatalog()
+        for idx, name in state["Catalog"].items():
+            catalog.Add(idx, name)
+        syncParameters = {idx: DeviceParameters(**fields) for idx, fields in state["Parameters"].items()}
+        syncDevices = {idx: DeviceValues(**fields) for idx, fields in state["Values"].items()}
+        sequence = state["Sequence"]
+        version = int(state["Version"])
+        clean = bool(state["Clean"])
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        Domoticz.Error(F"{marker} {e} when loading {variables.stateFileName}")
+        return False
+    # Keep sequence of previous run only if all versions it gave are known, else slaves will get everything again
+    if clean:
+        variables.masterSequence = sequence
+    variables.versionCounter = version
+    variables.deviceCatalog = catalog
+    variables.syncParameters = syncParameters
+    variables.syncDevices = syncDevices
+    for fields in list(syncParameters.values()) + list(syncDevices.values()):
+        if fields.Sequence != variables.masterSequence:
+            fields.Sequence = variables.masterSequence
+    # Apply mapping to restored devices
+    loadMapping(variables.mapping)
+    variables.restoredVersion = variables.versionCounter
+    variables.savedStateVersion = variables.versionCounter
+    Domoticz.Log(F"{marker} {len(variables.syncParameters)} devices restored from {variables.stateFileName}" \
+        +F", sequence {variables.masterSequence}{'' if clean else ' (new)'}")
+    return True
+
+# Load device definitions, from local Domoticz database if readable, else from a database backup
+def loadDefinitions():
+    marker = makeMarker("loadDefinitions", parameters=lambda: F"source {variables.definitionsSource}")
+    if variables.definitionsSource != "backup":
+        databaseName = str(getValue(Parameters, "Database"))
+        if databaseName != "" and os.path.isfile(databaseName):
+            try:
+                # Open database read only, as Domoticz is using it
+                variables.databaseConnecion = sqlite3.connect(F"file:{quote(databaseName)}?mode=ro", uri=True, timeout=5)
+                loadDefinitionsFromDb()
+                return
+            except sqlite3.Error as e:
+                Domoticz.Error(F"{marker} {e} when reading {databaseName}")
+            finally:
+                if variables.databaseConnecion != None:
+                    variables.databaseConnecion.close()
+                    variables.databaseConnecion = None
+        if variables.definitionsSource == "database":
+            Domoticz.Error(F"{marker} Can't read Domoticz database >{databaseName}<, requesting database backup")
         else:
-            # Client don't exists, create it
-            prepareSendingSlaveUpdate()
-        
+            Domoticz.Log(F"{marker} Can't read Domoticz database >{databaseName}<, requesting database backup")
+    requestBackupDatabaseData()
+
+# Is slave MQTT connected?
+def isSlaveConnected(link):
+    return link.mqttClient != None and link.mqttClient.connection != None \
+        and link.mqttClient.connection.Connected()
+
+# Queue a message (with encoded payload) to a slave and send it if possible
+#   A message not yet sent with same key (topic by default) is replaced, moving it at end of queue to keep versions order
+def queueSlavePublish(link, topic, payload, retain, key=None):
+    if key == None:
+        key = topic
+    link.outbound.pop(key, None)
+    link.outbound[key] = (topic, payload, retain)
+    variables.metrics.Observe(F"outboundQueue.{link.name}", len(link.outbound), variables.depthBuckets)
+    flushSlaveQueue(link)
+
+# Send messages queued for a slave, by bursts
+#   After a burst, wait for broker to answer a ping before sending next one, so that a slow slave only delays its own messages
+def flushSlaveQueue(link):
+    while link.outbound and not link.waitingPingResp and isSlaveConnected(link):
+        key, (topic, payload, retain) = link.outbound.popitem(last=False)
+        link.mqttClient.PublishBytes(topic, payload, retain)
+        link.burstCount += 1
+        if link.burstCount >= variables.slaveQueueBurst:
+            link.waitingPingResp = True
+            link.burstTime = time.time()
+            link.mqttClient.Ping()
+            scheduleTask(F"burst.{link.name}", variables.pingInterval, functools.partial(onSlaveBurstTimeout, link))
+
+# Resume sending to a slave if ping sent after a burst was never answered
+def onSlaveBurstTimeout(link):
+    if link.waitingPingResp:
+        link.burstCount = 0
+        link.waitingPingResp = False
+        flushSlaveQueue(link)
+
+# Compare a numeric sValue with last published one, given a deadband
+def isOutsideDeadband(sValue, lastSValue, deadband):
+    newParts = str(sValue).split(";")
+    lastParts = str(lastSValue).split(";")
+    if len(newParts) != len(lastParts):
+        return True
+    for newPart, lastPart in zip(newParts, lastParts):
+        try:
+            if abs(float(newPart) - float(lastPart)) > deadband:
+                return True
+        except ValueError:
+            # Not numeric, compare as string
+            if newPart != lastPart:
+                return True
+    return False
+
+# Check device values against publish filter, returns True if they should be published now to a slave
+def shouldPublishValues(link, idx):
+    publishFilter = variables.publishFilters.get(idx)
+    if publishFilter == None:
+        return True
+    fields = variables.syncDevices[idx]
+    lastValues = link.lastPublishedValues.get(idx)
+    if lastValues != None:
+        lastNValue, lastSValue, lastColor = lastValues
+        # Only LastUpdate changed, nothing to publish
+        if fields.nValue == lastNValue and fields.sValue == lastSValue and fields.Color == lastColor:
+            link.pendingValues.discard(idx)
+            return False
+        if publishFilter["mode"] == "deadband" and fields.nValue == lastNValue and fields.Color == lastColor \
+                and not isOutsideDeadband(fields.sValue, lastSValue, publishFilter["deadband"]):
+            return False
+    if publishFilter["minInterval"] > 0:
+        delay = link.lastPublishedTime.get(idx, 0) + publishFilter["minInterval"] - time.time()
+        if delay > 0:
+            # Too early, keep it to be sent on trailing edge
+            link.pendingValues.add(idx)
+            scheduleTask(F"pending.{link.name}", delay, functools.partial(flushPendingValues, link), earliest=True)
+            return False
+    return True
+
+# Publish device values to slave (and remember what was published)
+#   Values are added to current batch when batch mode is active, else sent on device retained topic
+def publishMasterValues(link, idx):
+    if isSlaveConnected(link):
+        fields = variables.syncDevices[idx]
+        if variables.batchWindow > 0:
+            if not link.batchValues:
+                link.batchStartTime = time.time()
+                scheduleTask(F"batch.{link.name}", variables.batchWindow, functools.partial(flushBatchValues, link))
+            link.batchValues[idx] = None
+        else:
+            queueSlavePublish(link, F"{link.rootTopic}/{variables.masterValues}/{idx}", encodeRecord(link, fields), 1)
+        link.lastPublishedValues[idx] = (fields.nValue, fields.sValue, fields.Color)
+        link.lastPublishedTime[idx] = time.time()
+        link.pendingValues.discard(idx)
+        if len(link.batchValues) >= variables.batchMaxDevices:
+            flushBatchValues(link)
+
+# Publish device parameters on device retained topic
+def publishMasterParameters(link, idx):
+    if isSlaveConnected(link):
+        queueSlavePublish(link, F"{link.rootTopic}/{variables.masterParameters}/{idx}", \
+            encodeRecord(link, variables.syncParameters[idx]), 1)
+
+# Publish device values on device retained topic (durable snapshot)
+def publishMasterSnapshot(link, idx):
+    if isSlaveConnected(link):
+        fields = variables.syncDevices[idx]
+        queueSlavePublish(link, F"{link.rootTopic}/{variables.masterValues}/{idx}", encodeRecord(link, fields), 1)
+        link.lastPublishedValues[idx] = (fields.nValue, fields.sValue, fields.Color)
+        link.lastPublishedTime[idx] = time.time()
+        link.pendingValues.discard(idx)
+        link.batchValues.pop(idx, None)
+        link.snapshotIdxes.discard(idx)
+
+# Send current batch of values to slave in one frame
+def flushBatchValues(link):
+    marker = makeMarker("flushBatchValues", instance=link.name, parameters=lambda: F"{len(link.batchValues)} devices")
+    if link.batchValues and isSlaveConnected(link):
+        # Compose frame from (cached) payloads of devices, compressing it if large enough and supported by slave
+        frame = b"{" + b",".join(json.dumps(idx).encode("UTF-8") + b":" + encodeRecord(link, variables.syncDevices[idx]) \
+            for idx in link.batchValues) + b"}"
+        if link.compress and len(frame) >= variables.compressMinSize:
+            frame = zlib.compress(frame)
+        # Batch frames are never replaced by next ones, as they contain different devices
+        queueSlavePublish(link, F"{link.rootTopic}/{variables.masterBatch}", frame, 0, key=object())
+        # Retained topics of these devices should be refreshed later
+        if not link.snapshotIdxes:
+            link.lastSnapshotTime = time.time()
+            scheduleTask(F"snapshot.{link.name}", variables.snapshotInterval, functools.partial(flushSnapshotValues, link))
+        link.snapshotIdxes.update(link.batchValues)
+        link.batchValues = {}
+    # When slave is not connected, devices are kept in batch, to be sent by resync at reconnection
+    variables.scheduler.Cancel(F"batch.{link.name}")
+
+# Refresh retained topics of devices sent in batches since last refresh
+def flushSnapshotValues(link):
+    marker = makeMarker("flushSnapshotValues", instance=link.name, parameters=lambda: F"{len(link.snapshotIdxes)} devices")
+    for idx in list(link.snapshotIdxes):
+        publishMasterSnapshot(link, idx)
+    link.snapshotIdxes = set()
+    link.lastSnapshotTime = time.time()
+
+# Publish values held by minimum interval filter, once interval elapsed
+#   Values not yet due are checked again when first of them will be
+def flushPendingValues(link):
+    now = time.time()
+    nextDelay = None
+    for idx in list(link.pendingValues):
+        delay = link.lastPublishedTime.get(idx, 0) + variables.publishFilters[idx]["minInterval"] - now
+        if delay <= 0:
+            publishMasterValues(link, idx)
+        elif nextDelay == None or delay < nextDelay:
+            nextDelay = delay
+    # Values not published (slave not connected) are sent by resync at reconnection
+    if nextDelay != None:
+        scheduleTask(F"pending.{link.name}", nextDelay, functools.partial(flushPendingValues, link), earliest=True)
+
+# Give a new version to values not yet sent to a slave (held by publish filter or in current batch)
+#   Used at stop, for next start to send them to slaves having applied later changes
+def versionUnsentValues():
+    unsent = set()
+    for link in variables.slaveLinks:
+        unsent.update(link.pendingValues)
+        unsent.update(link.batchValues)
+    for idx in unsent:
+        variables.syncDevices[idx].Version = nextVersion()
+
+# Get next version, used to order device changes
+def nextVersion():
+    variables.versionCounter += 1
+    return variables.versionCounter
+
 # Send parameters and values to MQTT slave after (re)connection
-def sendParametersAndValuesToSlave():
-    marker = makeMarker("sendParametersAndValuesToSlave")
-    for idx in variables.syncParameters.keys():
-        if variables.slaveMqttClient != None:
-            if variables.slaveMqttClient.connection.Connected():
-                variables.slaveMqttClient.Publish(F"{variables.rootTopic}/{variables.masterParameters}/{idx}", \
-                    json.dumps(variables.syncParameters[idx]), retain=1)
-    for idx in variables.syncDevices.keys():
-        if variables.slaveMqttClient != None:
-            if variables.slaveMqttClient.connection.Connected():
-                variables.slaveMqttClient.Publish(F"{variables.rootTopic}/{variables.masterValues}/{idx}", \
-                    json.dumps(variables.syncDevices[idx]), retain=1)
+#   Only changes after given version are sent (all if version is 0)
+def sendParametersAndValuesToSlave(link, sinceVersion=0):
+    marker = makeMarker("sendParametersAndValuesToSlave", instance=link.name, parameters=lambda: F"since version {sinceVersion}")
+    link.resyncPending = False
+    # Build list of changes, sent by increasing version, for slave to know that it got all changes below last one applied
+    changes = []
+    for idx in link.idxSet:
+        if idx in variables.syncParameters:
+            version = variables.syncParameters[idx].Version
+            if version > sinceVersion:
+                changes.append((version, variables.masterParameters, idx))
+        version = variables.syncDevices[idx].Version or 0
+        # Also send values not yet sent (held by publish filter or in current batch)
+        if version > sinceVersion or idx in link.pendingValues or idx in link.batchValues:
+            changes.append((version, variables.masterValues, idx))
+    changes.sort()
+    Domoticz.Log(F"{marker} Sending {len(changes)} changes since version {sinceVersion}")
+    for version, subTopic, idx in changes:
+        if subTopic == variables.masterParameters:
+            publishMasterParameters(link, idx)
+        else:
+            publishMasterSnapshot(link, idx)
+
+# Called when slave state is received on master
+def onSlaveStateReceived(link, payload):
+    marker = makeMarker("onSlaveStateReceived", instance=link.name, parameters=lambda: F"{payload}")
+    if link.resyncPending:
+        jsonPayload = json.loads(payload)
+        # Send only changes since last version applied by slave, if slave is in sync with this master run
+        if getValue(jsonPayload, "Sequence") == variables.masterSequence:
+            sendParametersAndValuesToSlave(link, getValue(jsonPayload, "Version", 0))
+        else:
+            sendParametersAndValuesToSlave(link)
+
+# Send everything to slave if its state was not received in time
+def onSlaveResyncTimeout(link):
+    if link.resyncPending:
+        sendParametersAndValuesToSlave(link)
+
+# Called when LWT of other instance is received on slave MQTT, to use encodings it can decode
+def onPeerLwtReceived(link, payload):
+    marker = makeMarker("onPeerLwtReceived", instance=link.name, parameters=lambda: F"{payload}")
+    jsonPayload = json.loads(payload)
+    # Keep last known encodings when other instance is down, as its retained messages are read at restart
+    if getValue(jsonPayload, "state") == "up":
+        encodings = getValue(jsonPayload, "encodings", [])
+        link.compact = "compact" in encodings
+        link.compress = "zlib" in encodings
+
+# Called when slave MQTT ping response is received
+def onSlaveMqttPingResp(link):
+    # Broker got everything sent before ping, next burst can be sent
+    link.burstCount = 0
+    link.waitingPingResp = False
+    variables.scheduler.Cancel(F"burst.{link.name}")
+    # On master, a pending resync means that no slave state was received after subscription (as broker sends
+    #   retained messages before answering ping), so send everything
+    if variables.areWeOnMaster and link.resyncPending:
+        sendParametersAndValuesToSlave(link)
+    flushSlaveQueue(link)
+
+# Remember last version applied on slave
+def saveAppliedVersion(jsonPayload):
+    sequence = getValue(jsonPayload, "Sequence")
+    version = getValue(jsonPayload, "Version", 0)
+    if sequence == "":
+        return
+    if sequence != variables.appliedSequence:
+        # Ignore messages from older master runs
+        if sequence > variables.appliedSequence:
+            variables.appliedSequence = sequence
+            variables.appliedVersion = version
+    elif version > variables.appliedVersion:
+        variables.appliedVersion = version
+
+# Publish (on slave) last version applied, for master to only send changes after it at reconnection
+def publishSlaveState(link):
+    if variables.appliedSequence != "" and isSlaveConnected(link):
+        state = {"Sequence": variables.appliedSequence, "Version": variables.appliedVersion}
+        if state != variables.publishedSlaveState:
+            link.mqttClient.Publish(F"{link.rootTopic}/{variables.slaveState}", json.dumps(state), retain=1)
+            variables.publishedSlaveState = state
 
 # Subscribe for slave values changes from Master
-def subscribeSlaveValuesFromMaster():
-    marker = makeMarker("subscribeSlaveValuesFromMaster")
-    if variables.slaveMqttClient != None:
-        if variables.slaveMqttClient.connection.Connected:
-            variables.slaveMqttClient.Subscribe(F"{variables.rootTopic}/{variables.slaveValues}/#")
-
-# Subscribe for master changes on parameters from slave
-def subscribeMasterParametersFromSlave():
-    marker = makeMarker("subscribeMasterParametersFromSlave")
-    if variables.slaveMqttClient != None:
-        if variables.slaveMqttClient.connection.Connected:
-            variables.slaveMqttClient.Subscribe(F"{variables.rootTopic}/{variables.masterParameters}/#")
-
-# Subscribe for master changes on values from slave
-def subscribeMasterValuesFromSlave(idx):
-    marker = makeMarker("subscribeMasterValuesFromSlave")
-    if variables.slaveMqttClient != None:
-        if variables.slaveMqttClient.connection.Connected:
-            variables.slaveMqttClient.Subscribe(F"{variables.rootTopic}/{variables.masterValues}/{idx}")
+def subscribeSlaveValuesFromMaster(link):
+    marker = makeMarker("subscribeSlaveValuesFromMaster", instance=link.name)
+    if link.mqttClient != None:
+        if link.mqttClient.connection.Connected:
+            # Get slave LWT first, to know its encodings before sending anything
+            topics = [F"{link.rootTopic}/lwt/slaveOnSlave"] if variables.compactEncoding else []
+            link.mqttClient.Subscribe(topics + [F"{link.rootTopic}/{variables.slaveValues}/#", \
+                F"{link.rootTopic}/{variables.slaveState}"], variables.commandQos)
+
+# Subscribe for master changes on parameters and values from slave (in one request for all devices)
+def subscribeMasterParametersFromSlave(link):
+    marker = makeMarker("subscribeMasterParametersFromSlave", instance=link.name)
+    if link.mqttClient != None:
+        if link.mqttClient.connection.Connected:
+            topics = [F"{link.rootTopic}/lwt/slaveOnMaster"] if variables.compactEncoding else []
+            link.mqttClient.Subscribe(topics + [F"{link.rootTopic}/{variables.masterParameters}/#", \
+                F"{link.rootTopic}/{variables.masterValues}/#", \
+                F"{link.rootTopic}/{variables.masterBatch}"])
 
 # Request name2idx data (list of devices)
 def requestName2IdxData():
@@ -630,19 +2007,9 @@ def requestBackupDatabaseData():
     marker = makeMarker("requestBackupDatabaseData")
     if variables.httpClient != None:
         variables.httpClient = None
+    # Stream answer to disk, unless using https (which needs Domoticz HTTPS protocol)
     variables.httpClient = HttpClient(variables.backupDatabaseConnection, \
-        variables.domoticzAddress, variables.domoticzPort, variables.domoticzHttps)
-    # Open connection for database backup request
-    variables.httpClient.Open()
-
-# Prepare sending slave update
-def prepareSendingSlaveUpdate():
-    marker = makeMarker("prepareSendingSlaveUpdate")
-    if variables.httpClient != None:
-        if variables.httpClient.connection.Connected():
-            variables.httpClient = None
-    variables.httpClient = HttpClient(variables.sendSlaveUpdateConnection, \
-        variables.domoticzAddress, variables.domoticzPort, variables.domoticzHttps)
+        variables.domoticzAddress, variables.domoticzPort, variables.domoticzHttps, not variables.domoticzHttps)
     # Open connection for database backup request
     variables.httpClient.Open()
 
@@ -691,6 +2058,9 @@ def askForDeviceList(Connection):
 # Ask Domoticz for Domoticz database copy
 def askForBackupDatabase(Connection):
     marker = makeMarker("askForBackupDatabase")
+    if variables.httpClient != None and variables.httpClient.isStreamed:
+        askForStreamedBackupDatabase(Connection)
+        return
     if variables.domoticzUsername != None and variables.domoticzUsername != "":
         authorizationText = variables.domoticzUsername
         if variables.domoticzPassword != "":
@@ -717,12 +2087,78 @@ def askForBackupDatabase(Connection):
     Connection.Send(sendData, 0)
     Domoticz.Debug(F"{marker} Send {str(sendData)}")
 
+# Ask Domoticz for Domoticz database copy, sending raw HTTP request and writing answer to disk as received
+def askForStreamedBackupDatabase(Connection):
+    marker = makeMarker("askForStreamedBackupDatabase")
+    request = "GET /backupdatabase.php HTTP/1.1\r\n" \
+        +F"Host: {variables.domoticzAddress}:{variables.domoticzPort}\r\n" \
+        +"Accept: */*\r\n" \
+        +"Connection: close\r\n" \
+        +"User-Agent: Domoticz/1.0\r\n"
+    if variables.domoticzUsername != None and variables.domoticzUsername != "":
+        authorizationText = variables.domoticzUsername
+        if variables.domoticzPassword != None and variables.domoticzPassword != "":
+            authorizationText += ":" + variables.domoticzPassword
+        authorization = base64.b64encode(authorizationText.encode('ascii')).decode("UTF_8")
+        request += F"Authorization: Basic {authorization}\r\n"
+    request += "\r\n"
+    variables.backupReader = HttpStreamReader(variables.databaseCopyFileName + ".part")
+    Connection.Send(request.encode("ascii"))
+
+# Called when data of streamed database copy is received
+def onHttpBackupDatabaseStream(Connection, data):
+    marker = makeMarker("onHttpBackupDatabaseStream", ignore=True)
+    reader = variables.backupReader
+    try:
+        reader.Feed(data)
+    except (ValueError, IndexError) as e:
+        Domoticz.Error(F"{marker} {e} when reading HTTP answer")
+        abortStreamedBackupDatabase(Connection)
+        return
+    if reader.status != None and reader.status != 200:
+        Domoticz.Error(F"{marker} Error {reader.status} returned by HTTP")
+        abortStreamedBackupDatabase(Connection)
+    elif reader.complete:
+        endStreamedBackupDatabase(Connection)
+
+# Called when streamed database copy connection is closed
+def onHttpBackupDatabaseStreamDisconnected(Connection):
+    marker = makeMarker("onHttpBackupDatabaseStreamDisconnected")
+    reader = variables.backupReader
+    reader.Disconnected()
+    if reader.complete:
+        endStreamedBackupDatabase(Connection)
+    else:
+        Domoticz.Error(F"{marker} Connection closed after {reader.received} bytes, database copy incomplete")
+        abortStreamedBackupDatabase(Connection)
+
+# Streamed database copy received, load it
+def endStreamedBackupDatabase(Connection):
+    marker = makeMarker("endStreamedBackupDatabase", parameters=lambda: F"{variables.backupReader.received} bytes")
+    reader = variables.backupReader
+    variables.backupReader = None
+    reader.Close()
+    if Connection.Connected():
+        Connection.Disconnect()
+    os.replace(reader.fileName, variables.databaseCopyFileName)
+    loadDefinitionsFromDatabaseCopy()
+
+# Stop streamed database copy, removing partial file
+def abortStreamedBackupDatabase(Connection):
+    reader = variables.backupReader
+    variables.backupReader = None
+    reader.Close()
+    if Connection.Connected():
+        Connection.Disconnect()
+    try:
+        os.remove(reader.fileName)
+    except:
+        pass
+
 # Send an update command received from slave
-def sendSlaveUpdate(Connection):
-    # Get next update to send
-    apiParams = variables.sendApiUpdateList.pop(0)
-    marker = makeMarker("sendSlaveUpdate", parameters=F"Parameters={apiParams}")
-    if variables.domoticzUsername != "":
+def sendSlaveUpdate(Connection, apiParams):
+    marker = makeMarker("sendSlaveUpdate", parameters=lambda: F"Parameters={apiParams}")
+    if variables.domoticzUsername != None and variables.domoticzUsername != "":
         authorizationText = variables.domoticzUsername
         if variables.domoticzPassword != None and variables.domoticzPassword != "":
             authorizationText += ":" + variables.domoticzPassword
@@ -746,11 +2182,12 @@ def sendSlaveUpdate(Connection):
                                 'User-Agent':'Domoticz/1.0' }
                     }
     Connection.Send(sendData, 0)
-    Domoticz.Debug(F"{marker} Send {str(sendData)}")
+    if variables.debugEnabled:
+        Domoticz.Debug(F"{marker} Send {str(sendData)}")
 
 # Decode a (remote) command and prepare fields to send to Domoticz API
 def decodeOnCommand(Unit, Command, Level, Color, Idx, Type, SubType, SwitchType):
-    marker = makeMarker("decodeOnCommand", parameters=F"{Unit}, {Command}, {Level}, {Color}", ignore=True)
+    marker = makeMarker("decodeOnCommand", parameters=lambda: F"{Unit}, {Command}, {Level}, {Color}", ignore=True)
     pTypeSetpoint = 0xF2
     fields = {}
     if Command == "On" or Command == "Off" or Command == "Toggle" or Command == "Stop" or Command == "Open" or Command == "Close":
@@ -783,9 +2220,9 @@ def decodeOnCommand(Unit, Command, Level, Color, Idx, Type, SubType, SwitchType)
 
 # Called after master subscription acknoledgment
 def onMasterMqttSubAck(Connection, topics):
-    marker = makeMarker("onMasterMqttSubAck", parameters=F"{topics}")
+    marker = makeMarker("onMasterMqttSubAck", parameters=lambda: F"{topics}")
     if topics == variables.domoticzOutTopic:
-        requestBackupDatabaseData()
+        loadDefinitions()
     else:
         Domoticz.Error(F"{marker} Unexpected topics {topics}")
 
@@ -797,7 +2234,7 @@ def onHttpConnected(Connection):
     if Connection.Name == variables.backupDatabaseConnection:
         askForBackupDatabase(Connection)
     if Connection.Name == variables.sendSlaveUpdateConnection:
-        sendNextSlaveUpdate()
+        variables.apiUpdateSender.OnConnected()
 
 # Called after master MQTT connection
 def onMasterConnected(Connection):
@@ -806,16 +2243,17 @@ def onMasterConnected(Connection):
         variables.masterMqttClient.SendId()
 
 # Called after slave MQTT connection
-def onSlaveConnected(Connection):
-    marker = makeMarker("onSlaveConnected")
-    if variables.slaveMqttClient != None:
-        variables.slaveMqttClient.SendId()
+def onSlaveConnected(link, Connection):
+    marker = makeMarker("onSlaveConnected", instance=link.name)
+    if link.mqttClient != None:
+        link.mqttClient.SendId()
 
 # Called after master MQTT connection acknoledgment (Connect ID received ok)
 def onMasterMqttConAck(Connection):
     marker = makeMarker("onMasterMqttConAck", instance=Connection.Name)
     # Send LWT data
     if variables.masterMqttClient != None:
+        variables.masterMqttClient.OnConnAck()
         if variables.masterMqttClient.lwtTopic != "":
             lwtData = {}
             lwtData["state"] = "up"
@@ -825,172 +2263,413 @@ def onMasterMqttConAck(Connection):
     askForDomoticzChanges(Connection)
 
 # Called after slave MQTT connection acknoledgment (Connect ID received ok)
-def onSlaveMqttConAck(Connection):
+def onSlaveMqttConAck(link, Connection):
     marker = makeMarker("onSlaveMqttConAck", instance=Connection.Name)
     # Send LWT data
-    if variables.slaveMqttClient != None:
-        if variables.slaveMqttClient.lwtTopic != "":
+    if link.mqttClient != None:
+        link.mqttClient.OnConnAck()
+        if link.mqttClient.lwtTopic != "":
             lwtData = {}
             lwtData["state"] = "up"
             lwtData["version"] =  variables.pluginVersion
             lwtData["since"] = variables.masterSequence
-            variables.slaveMqttClient.Publish(variables.slaveMqttClient.lwtTopic, json.dumps(lwtData), retain=1)
+            # Give encodings we can decode to other instance
+            if variables.compactEncoding:
+                lwtData["encodings"] = variables.encodings
+            link.mqttClient.Publish(link.mqttClient.lwtTopic, json.dumps(lwtData), retain=1)
+        # Messages not sent before (re)connection are covered by resync
+        link.outbound.clear()
+        link.burstCount = 0
+        link.waitingPingResp = False
         if variables.areWeOnMaster:
-            sendParametersAndValuesToSlave()
-            subscribeSlaveValuesFromMaster()
+            # Get slave state first, changes will be sent when received (or ping answered if no state)
+            link.resyncPending = True
+            link.resyncRequestTime = time.time()
+            scheduleTask(F"resync.{link.name}", variables.resyncTimeout, functools.partial(onSlaveResyncTimeout, link))
+            subscribeSlaveValuesFromMaster(link)
+            link.mqttClient.Ping()
         else:
-            subscribeMasterParametersFromSlave()
+            subscribeMasterParametersFromSlave(link)
+            variables.publishedSlaveState = None
+            publishSlaveState(link)
 
-# Called after a message has been received on master MQTT
-def onMasterReceived(Connection, topic, payload):
+# Called after a message has been received on domoticz/out topic on master MQTT
+def onMasterReceived(payload):
     marker = makeMarker("onMasterReceived")
-    # Is this a message from domoticz/out topic on master MQTT?
-    if topic == variables.domoticzOutTopic:
-        jsonPayload = json.loads(payload)
-        idx = str(getValue(jsonPayload, "idx"))
-        Domoticz.Debug(F"{marker} idx {idx}, payload {json.dumps(jsonPayload)}")
-        # Is idx in device to synchronize list?
-        if idx in variables.syncDevices.keys():
-            # Update syncDevices with nValue and sValue
-            deviceParams = variables.syncDevices[idx]
-            nValue = getValue(jsonPayload,"nvalue")
-            if nValue != "":
-                deviceParams["nValue"] = nValue
-            sValue = getValue(jsonPayload,"svalue")
-            if sValue == "":
-                for i in range(10):
-                    if "svalue"+str(i) in jsonPayload:
-                        sValue += (";" if sValue != "" else "") + jsonPayload["svalue"+str(i)]
-            if sValue != "":
-                deviceParams["sValue"] = sValue
-            lastUpdate = getValue(jsonPayload,"LastUpdate")
-            if lastUpdate != "":
-                deviceParams["LastUpdate"] = lastUpdate
-            color = getValue(jsonPayload,"Color")
-            if color != "":
-                deviceParams["Color"] = color
-            variables.syncDevices[idx] = deviceParams
-            # Should we send updates to slave?
-            if variables.slaveMqttClient != None:
-                if variables.slaveMqttClient.connection.Connected:
-                    variables.slaveMqttClient.Publish(F"{variables.rootTopic}/{variables.masterValues}/{idx}", \
-                        json.dumps(variables.syncDevices[idx]), retain=1)
+    jsonPayload = json.loads(payload)
+    idx = str(getValue(jsonPayload, "idx"))
+    if variables.debugEnabled:
+        Domoticz.Debug(F"{marker} idx {idx}, payload {payload}")
+    # Is idx in device to synchronize list?
+    if idx in variables.syncDevices.keys():
+        # Update syncDevices with nValue and sValue
+        deviceParams = variables.syncDevices[idx]
+        nValue = getValue(jsonPayload,"nvalue")
+        if nValue != "":
+            deviceParams.nValue = nValue
+        sValue = getValue(jsonPayload,"svalue")
+        if sValue == "":
+            for i in range(10):
+                if "svalue"+str(i) in jsonPayload:
+                    sValue += (";" if sValue != "" else "") + jsonPayload["svalue"+str(i)]
+        if sValue != "":
+            deviceParams.sValue = sValue
+        lastUpdate = getValue(jsonPayload,"LastUpdate")
+        if lastUpdate != "":
+            deviceParams.LastUpdate = lastUpdate
+        color = getValue(jsonPayload,"Color")
+        if color != "":
+            deviceParams.Color = color
+        deviceParams.Version = nextVersion()
+        # Should we send updates to slaves using this device?
+        for link in variables.slaveLinks:
+            if idx in link.idxSet:
+                if shouldPublishValues(link, idx):
+                    publishMasterValues(link, idx)
+                # Send current batch if window elapsed
+                if link.batchValues and time.time() - link.batchStartTime >= variables.batchWindow:
+                    flushBatchValues(link)
+        if variables.debugEnabled:
             Domoticz.Debug(F"{marker} Updating idx {idx} with {variables.syncDevices[idx]}")
-    else:
-        Domoticz.Error("{marker} Unexpected topic {topic}, payload {payload}")
 
-# Called after a message has been received on slave MQTT connection on master
-def onSlaveReceived(Connection, topic, payload):
-    marker = makeMarker("onSlaveReceived")
-    if variables.areWeOnMaster:
-        # Is this a message from slaveValues topic on slave MQTT?
-        prefix = F"{variables.rootTopic}/{variables.slaveValues}/"
-        if topic.startswith(prefix):
-            idx = topic[len(prefix):]
-            jsonPayload = json.loads(payload)
-            Domoticz.Debug(F"{marker} idx {idx}, payload {json.dumps(jsonPayload)}")
-            # Is idx in device to synchronize list?
-            if idx in variables.syncDevices.keys():
-                # Get device characteristics
-                device = variables.syncDevices[idx]
-                Domoticz.Debug(F"{marker} Device={device}")
-                if variables.syncDevices[idx]['allowSlaveUpdate']:
-                    # Update master device with command received from slave
-                    device = variables.syncParameters[idx]
-                    fields = decodeOnCommand(Unit=None, Command=jsonPayload["Command"], \
-                                Level=jsonPayload["Level"], Color=jsonPayload["Color"], Idx=idx, \
-                                Type=device["Type"], SubType=device["SubType"], SwitchType=device["SwitchType"])
-                    # Send message to master Domoticz server
-                    if fields != None and fields != {}:
-                        apiParameters = ""
-                        for field in fields:
-                            apiParameters += "&"+field+"="+str(fields[field])
-                        apiParameters = "?" + apiParameters[1:]
-                        Domoticz.Debug(F"{marker} Update parameters={apiParameters}")
-                        # Add command to update list
-                        variables.sendApiUpdateList.append(apiParameters)
-                        sendNextSlaveUpdate()
-                else:
-                    Domoticz.Error("{marker} Remote changes not allowed for idx {idx}")
-            else:
-                Domoticz.Error(F"{marker} Can't find idx {idx} in {variables.syncDevices.keys()}")
+# Create or update (slave local) device with parameters received from master
+def applyMasterParameters(idx, jsonPayload):
+    marker = makeMarker("applyMasterParameters", ignore=True)
+    # Ignore replays of parameters already applied (retained messages or resync after reconnection)
+    if isReplay(variables.appliedParameters, idx, jsonPayload):
+        variables.metrics.Count("replaysSkipped")
+        return
+    deviceName = F"{variables.slaveDevicePrefix}{jsonPayload['Name']}"
+    deviceType = jsonPayload['Type']
+    deviceSubType = jsonPayload['SubType']
+    deviceSwitchType = jsonPayload['SwitchType']
+    fingerprint = parametersFingerprint(deviceName, jsonPayload)
+    # Does device already exists?
+    device = getDevice(idx)
+    # Nothing to do if device exists with same parameters than last time
+    if device != None and variables.parametersFingerprints.get(idx) == fingerprint:
+        saveAppliedVersion(jsonPayload)
+        saveAppliedMessage(variables.appliedParameters, idx, jsonPayload)
+        return
+    options = decodeOptions(getValue(jsonPayload, "Options"))
+    deviceUnit = None
+    # If device type or subtype changed, delete device first, and recreate it with same unit
+    if device != None:
+        if device.Type != deviceType or device.SubType != deviceSubType:
+            deviceUnit = device.Unit
+            unindexDevice(device.Unit)
+            device.Delete()
+            device = None
+    if device == None:
+        # Allocate a free unit only when really creating a new device
+        if deviceUnit == None:
+            deviceUnit = allocateUnit()
+        # Create a new device
+        Domoticz.Log(F"{marker} Creating " \
+            +F"Name='{deviceName}', Unit='{deviceUnit}', " \
+            +F"Type='{deviceType}', Subtype='{deviceSubType}', " \
+            +F"Switchtype='{deviceSwitchType}', Options='{options}', " \
+            +F"DeviceID='{idx}', Used='True'")
+        device = Domoticz.Device(Name=deviceName, Unit=deviceUnit, \
+            Type=deviceType, Subtype=deviceSubType, \
+            Switchtype=deviceSwitchType, Options=options, \
+            DeviceID=idx, Used=True)
+        device.Create()
+        indexDevice(deviceUnit)
+    # Update existing device (at each startup and after creation, as plugin name is added by default)
+    nValueToSet = device.nValue
+    sValueToSet = device.sValue
+    deviceUnit = device.Unit
+    Domoticz.Log(F"{marker} Updating key '{idx}' " \
+        +F"Name='{deviceName}', Unit='{deviceUnit}', " \
+        +F"Type='{deviceType}', Subtype='{deviceSubType}', " \
+        +F"Switchtype='{deviceSwitchType}', Options='{options}', " \
+        +F"nValue='{nValueToSet}', sValue='{sValueToSet}', SuppressTriggers='True'")
+    device.Update(Name=deviceName, \
+        Type=deviceType, Subtype=deviceSubType, \
+        Switchtype=deviceSwitchType, Options=options, \
+        sValue=sValueToSet, nValue=nValueToSet, SuppressTriggers=True)
+    variables.parametersFingerprints[idx] = fingerprint
+    variables.parametersFingerprintsChanged = True
+    saveAppliedVersion(jsonPayload)
+    saveAppliedMessage(variables.appliedParameters, idx, jsonPayload)
+    # Apply values received before device creation
+    if idx in variables.waitingValues:
+        applyMasterValues(idx, variables.waitingValues.pop(idx))
+
+# Compute fingerprint of device parameters (excluding master sequence and version)
+def parametersFingerprint(deviceName, jsonPayload):
+    parameters = [deviceName, jsonPayload['Type'], jsonPayload['SubType'], jsonPayload['SwitchType'], getValue(jsonPayload, "Options")]
+    return hashlib.sha1(json.dumps(parameters).encode("UTF-8")).hexdigest()
+
+# Load parameters fingerprints saved by previous run
+def loadParametersFingerprints():
+    marker = makeMarker("loadParametersFingerprints")
+    variables.parametersFingerprints = {}
+    try:
+        with open(variables.parametersFingerprintsFileName, encoding = 'UTF-8') as fingerprintsStream:
+            variables.parametersFingerprints = json.load(fingerprintsStream)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        Domoticz.Error(F"{marker} {e} when loading {variables.parametersFingerprintsFileName}")
+    variables.parametersFingerprintsChanged = False
+    Domoticz.Debug(F"{marker} {len(variables.parametersFingerprints)} fingerprints loaded")
+
+# Save parameters fingerprints, if changed
+def saveParametersFingerprints():
+    marker = makeMarker("saveParametersFingerprints")
+    if variables.parametersFingerprintsChanged:
+        try:
+            with open(variables.parametersFingerprintsFileName + ".tmp", "w", encoding = 'UTF-8') as fingerprintsStream:
+                json.dump(variables.parametersFingerprints, fingerprintsStream)
+            os.replace(variables.parametersFingerprintsFileName + ".tmp", variables.parametersFingerprintsFileName)
+            variables.parametersFingerprintsChanged = False
+        except Exception as e:
+            Domoticz.Error(F"{marker} {e} when saving {variables.parametersFingerprintsFileName}")
+
+# Is a master message older than (or same as) last one applied on an existing device?
+def isReplay(applied, idx, jsonPayload):
+    last = applied.get(idx)
+    if last == None:
+        return False
+    sequence = getValue(jsonPayload, "Sequence")
+    return sequence != "" and (sequence, getValue(jsonPayload, "Version", 0)) <= last and getDevice(idx) != None
+
+# Remember sequence and version of last master message applied on a device
+def saveAppliedMessage(applied, idx, jsonPayload):
+    sequence = getValue(jsonPayload, "Sequence")
+    if sequence != "":
+        applied[idx] = (sys.intern(sequence), getValue(jsonPayload, "Version", 0))
+        variables.slaveCacheChanged = True
+
+# Load slave cache (versions applied) saved by previous run
+def loadSlaveCache():
+    marker = makeMarker("loadSlaveCache")
+    variables.appliedParameters = {}
+    variables.appliedValues = {}
+    variables.appliedAllowed = {}
+    try:
+        with open(variables.slaveCacheFileName, encoding = 'UTF-8') as cacheStream:
+            cache = json.load(cacheStream)
+        variables.appliedParameters = {idx: (sys.intern(sequence), version) for idx, (sequence, version) in cache["Parameters"].items()}
+        variables.appliedValues = {idx: (sys.intern(sequence), version) for idx, (sequence, version) in cache["Values"].items()}
+        # Restore update allowed flags, as master won't send unchanged values again
+        #   (cache saved without them: ask for all values, flags being restored from replays)
+        if "Allowed" in cache:
+            variables.appliedAllowed = cache["Allowed"]
+            for idx, allowed in variables.appliedAllowed.items():
+                device = getDevice(idx)
+                if device != None:
+                    variables.slaveUpdateAllowed[device.ID] = allowed
+            # Master will only send changes after last version applied
+            variables.appliedSequence = cache["Sequence"]
+            variables.appliedVersion = cache["Version"]
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        Domoticz.Error(F"{marker} {e} when loading {variables.slaveCacheFileName}")
+        variables.appliedParameters = {}
+        variables.appliedValues = {}
+        variables.appliedAllowed = {}
+    variables.slaveCacheChanged = False
+    Domoticz.Debug(F"{marker} {len(variables.appliedValues)} values versions loaded, last {variables.appliedSequence}/{variables.appliedVersion}")
+
+# Save slave cache, if changed
+def saveSlaveCache():
+    marker = makeMarker("saveSlaveCache")
+    if variables.slaveCacheChanged:
+        cache = {"Sequence": variables.appliedSequence, "Version": variables.appliedVersion, \
+            "Parameters": variables.appliedParameters, "Values": variables.appliedValues, "Allowed": variables.appliedAllowed}
+        try:
+            with open(variables.slaveCacheFileName + ".tmp", "w", encoding = 'UTF-8') as cacheStream:
+                json.dump(cache, cacheStream)
+            os.replace(variables.slaveCacheFileName + ".tmp", variables.slaveCacheFileName)
+            variables.slaveCacheChanged = False
+        except Exception as e:
+            Domoticz.Error(F"{marker} {e} when saving {variables.slaveCacheFileName}")
+
+# Update (slave local) device with values received from master
+def applyMasterValues(idx, jsonPayload):
+    marker = makeMarker("applyMasterValues", ignore=True)
+    device = getDevice(idx)
+    # Ignore replays of values already applied (retained messages or resync after reconnection)
+    if isReplay(variables.appliedValues, idx, jsonPayload):
+        # Update allowed flag may be missing from cache saved by a previous version, so it's restored from replays
+        if device != None:
+            variables.slaveUpdateAllowed[device.ID] = jsonPayload["allowSlaveUpdate"]
+        variables.metrics.Count("replaysSkipped")
+        return
+    if device != None:
+        nValueToSet = jsonPayload["nValue"]
+        sValueToSet = jsonPayload["sValue"]
+        colorToSet = getValue(jsonPayload, "Color")
+        if colorToSet != "":
+            colorToSetStr = json.dumps(colorToSet)
+            if nValueToSet != device.nValue or sValueToSet != device.sValue or colorToSet != device.Color:
+                Domoticz.Log(F"{marker} Updating key {idx} " \
+                    +F"Name={device.Name}, "\
+                    +F"nValue={nValueToSet}, sValue={sValueToSet}, Color={colorToSetStr}")
+                device.Update(nValue=nValueToSet, sValue=sValueToSet, Color=colorToSetStr)
         else:
-            Domoticz.Error("{marker} Unexpected topic {topic}, payload {payload}")
+            if nValueToSet != device.nValue or sValueToSet != device.sValue:
+                Domoticz.Log(F"{marker} Updating key {idx} " \
+                    +F"Name={device.Name}, "\
+                    +F"nValue={nValueToSet}, sValue={sValueToSet}")
+                device.Update(nValue=nValueToSet, sValue=sValueToSet)
+        # Save update allowed flag
+        variables.slaveUpdateAllowed[device.ID] = jsonPayload["allowSlaveUpdate"]
+        variables.appliedAllowed[idx] = jsonPayload["allowSlaveUpdate"]
+        saveAppliedVersion(jsonPayload)
+        saveAppliedMessage(variables.appliedValues, idx, jsonPayload)
+        observeLatency(jsonPayload)
     else:
-        # Is this a message from masterParameters or matsreValues topics on slave MQTT?
-        prefix1 = F"{variables.rootTopic}/{variables.masterParameters}/"
-        prefix2 = F"{variables.rootTopic}/{variables.masterValues}/"
-        jsonPayload = json.loads(payload)
-        if topic.startswith(prefix1):
-            # Here, we receive a parameters values message from master (either at startup as retained, or dynamically)
-            idx = topic[len(prefix1):]
-            deviceName = F"{variables.slaveDevicePrefix}{jsonPayload['Name']}"
-            deviceType = jsonPayload['Type']
-            deviceSubType = jsonPayload['SubType']
-            deviceSwitchType = jsonPayload['SwitchType']
-            options = decodeOptions(getValue(jsonPayload, "Options"))
-            # Does device already exists?
-            device = getDevice(idx)
-            deviceUnit = getNextDeviceId()
-            # If device type or subtype changed, delete device first, and recreate it with same device id
-            if device != None:
-                if device.Type != deviceType or device.SubType != deviceSubType:
-                    deviceUnit = device.DeviceID
-                    device.Delete()
-                    device = None
-            if device == None:
-                # Create a new device
-                Domoticz.Log(F"{marker} Creating " \
-                    +F"Name='{deviceName}', Unit='{deviceUnit}', " \
-                    +F"Type='{deviceType}', Subtype='{deviceSubType}', " \
-                    +F"Switchtype='{deviceSwitchType}', Options='{options}', " \
-                    +F"DeviceID='{idx}', Used='True'")
-                device = Domoticz.Device(Name=deviceName, Unit=deviceUnit, \
-                    Type=deviceType, Subtype=deviceSubType, \
-                    Switchtype=deviceSwitchType, Options=options, \
-                    DeviceID=idx, Used=True)
-                device.Create()
-            # Update existing device (at each startup and after creation, as plugin name is added by default)
-            nValueToSet = device.nValue
-            sValueToSet = device.sValue
-            deviceUnit = device.DeviceID
-            Domoticz.Log(F"{marker} Updating key '{idx}' " \
-                +F"Name='{deviceName}', Unit='{deviceUnit}', " \
-                +F"Type='{deviceType}', Subtype='{deviceSubType}', " \
-                +F"Switchtype='{deviceSwitchType}', Options='{options}', " \
-                +F"nValue='{nValueToSet}', sValue='{sValueToSet}', SuppressTriggers='True'")
-            device.Update(Name=deviceName, \
-                Type=deviceType, Subtype=deviceSubType, \
-                Switchtype=deviceSwitchType, Options=options, \
-                sValue=sValueToSet, nValue=nValueToSet, SuppressTriggers=True)
-            # Ask for value changes
-            subscribeMasterValuesFromSlave(idx)
-        elif topic.startswith(prefix2):
-            idx = topic[len(prefix2):]
-            device = getDevice(idx)
-            if device != None:
-                nValueToSet = jsonPayload["nValue"]
-                sValueToSet = jsonPayload["sValue"]
-                colorToSet = getValue(jsonPayload, "Color")
-                if colorToSet != "":
-                    colorToSetStr = json.dumps(colorToSet)
-                    if nValueToSet != device.nValue or sValueToSet != device.sValue or colorToSet != device.Color:
-                        Domoticz.Log(F"{marker} Updating key {idx} " \
-                            +F"Name={device.Name}, "\
-                            +F"nValue={nValueToSet}, sValue={sValueToSet}, Color={colorToSetStr}")
-                        device.Update(nValue=nValueToSet, sValue=sValueToSet, Color=colorToSetStr)
-                else:
-                    if nValueToSet != device.nValue or sValueToSet != device.sValue:
-                        Domoticz.Log(F"{marker} Updating key {idx} " \
-                            +F"Name={device.Name}, "\
-                            +F"nValue={nValueToSet}, sValue={sValueToSet}")
-                        device.Update(nValue=nValueToSet, sValue=sValueToSet)
-                # Save update allowed flag
-                variables.slaveUpdateAllowed[device.ID] = jsonPayload["allowSlaveUpdate"]
-            else:
-                Domoticz.Error(F"{marker} Can't find device matching idx {idx}")
+        # Device not (yet) created, keep values until its parameters are received
+        if variables.debugEnabled:
+            Domoticz.Debug(F"{marker} Can't find device matching idx {idx}, keeping values")
+        variables.waitingValues.pop(idx, None)
+        variables.waitingValues[idx] = jsonPayload
+        if len(variables.waitingValues) > variables.maxWaitingValues:
+            oldestIdx = next(iter(variables.waitingValues))
+            Domoticz.Error(F"{marker} Parameters of idx {oldestIdx} never received, ignoring its values")
+            del variables.waitingValues[oldestIdx]
+
+# Convert a Domoticz LastUpdate (local time) into a timestamp (None if not valid)
+#   Last conversions are cached, as many devices are updated in the same second
+@functools.lru_cache(maxsize=64)
+def lastUpdateTimestamp(lastUpdate):
+    try:
+        return time.mktime(time.strptime(lastUpdate, "%Y-%m-%d %H:%M:%S"))
+    except (ValueError, TypeError):
+        return None
+
+# Add master to slave latency of received values to metrics (values sent again at reconnection fall in last bucket)
+def observeLatency(jsonPayload):
+    timestamp = lastUpdateTimestamp(getValue(jsonPayload, "LastUpdate"))
+    if timestamp != None:
+        variables.metrics.Observe("latency", max(0, time.time() - timestamp), variables.latencyBuckets)
+
+# Collect current queue depths
+def collectGauges():
+    gauges = {}
+    if variables.apiUpdateSender != None:
+        gauges["apiUpdateQueue"] = len(variables.apiUpdateSender.queue)
+    if variables.commandLimiter != None:
+        gauges["heldCommands"] = len(variables.commandLimiter.held)
+    for link in variables.slaveLinks:
+        gauges[F"outboundQueue.{link.name}"] = len(link.outbound)
+        if variables.commandQos == 1 and link.mqttClient != None:
+            gauges[F"inFlight.{link.name}"] = len(link.mqttClient.inFlight) + len(link.mqttClient.waiting)
+    gauges["waitingValues"] = len(variables.waitingValues)
+    return gauges
+
+# Publish metrics summary on (retained) stats topic, and update stats devices if asked for
+def publishStats():
+    marker = makeMarker("publishStats")
+    summary = variables.metrics.Summary(collectGauges())
+    summary["since"] = variables.masterSequence
+    if variables.areWeOnMaster:
+        client = variables.masterMqttClient
+        topic = F"{variables.rootTopic}/{variables.statsTopic}/master"
+    else:
+        client = variables.slaveLinks[0].mqttClient
+        topic = F"{variables.slaveLinks[0].rootTopic}/{variables.statsTopic}/slave"
+    if client != None and client.connection != None and client.connection.Connected():
+        client.Publish(topic, json.dumps(summary), retain=1)
+    if variables.statsDevices:
+        updateStatsDevices(summary)
+
+# Update (custom sensor) devices showing main metrics, creating them if needed
+def updateStatsDevices(summary):
+    marker = makeMarker("updateStatsDevices")
+    received = sum(rate for name, rate in summary["rates"].items() if name.startswith("received."))
+    published = sum(rate for name, rate in summary["rates"].items() if name.startswith("published."))
+    queued = sum(summary["gauges"].values())
+    handler = summary["histograms"].get("onMasterReceived" if variables.areWeOnMaster else "onSlaveReceived")
+    stats = [("received", "Received messages", "msg/s", received), \
+        ("published", "Published messages", "msg/s", published), \
+        ("queued", "Queued messages", "msg", queued), \
+        ("handlingTime", "Message handling time", "ms", handler["mean"] * 1000 if handler != None else 0)]
+    if not variables.areWeOnMaster:
+        latency = summary["histograms"].get("latency")
+        stats.append(("latency", "Master to slave latency (95%)", "s", latency["p95"] if latency != None else 0))
+    for key, name, units, value in stats:
+        deviceId = F"{variables.statsDeviceIdPrefix}{key}"
+        device = getDevice(deviceId)
+        if device == None:
+            unit = allocateUnit()
+            Domoticz.Log(F"{marker} Creating Name='{name}', Unit='{unit}', DeviceID='{deviceId}'")
+            Domoticz.Device(Name=name, Unit=unit, TypeName="Custom", Options={"Custom": F"1;{units}"}, \
+                DeviceID=deviceId, Used=True).Create()
+            indexDevice(unit)
+            device = getDevice(deviceId)
+        if device != None:
+            device.Update(nValue=0, sValue=F"{value:.3f}")
+
+# Called after a message has been received on slaveValues topic on master
+def onSlaveValuesReceived(link, idx, payload):
+    marker = makeMarker("onSlaveValuesReceived", instance=link.name)
+    if variables.debugEnabled:
+        Domoticz.Debug(F"{marker} idx {idx}, payload {payload}")
+    # Is idx in device to synchronize list (with this slave)?
+    if idx in link.idxSet:
+        # Get device characteristics
+        device = variables.syncDevices[idx]
+        if variables.debugEnabled:
+            Domoticz.Debug(F"{marker} Device={device}")
+        if variables.syncDevices[idx].allowSlaveUpdate:
+            # Update master device with command received from slave
+            jsonPayload = decodePayload(payload, variables.commandFields)
+            # Ignore commands already received (sent again with QoS 1 when acknowledgment was lost)
+            messageId = getValue(jsonPayload, "MessageId")
+            if messageId != "":
+                if messageId in link.receivedMessageIds:
+                    if variables.debugEnabled:
+                        Domoticz.Debug(F"{marker} Ignoring duplicate message {messageId}")
+                    variables.metrics.Count("duplicatesSkipped")
+                    return
+                link.receivedMessageIds[messageId] = None
+                if len(link.receivedMessageIds) > variables.maxReceivedMessageIds:
+                    link.receivedMessageIds.popitem(last=False)
+            device = variables.syncParameters[idx]
+            fields = decodeOnCommand(Unit=None, Command=jsonPayload["Command"], \
+                        Level=jsonPayload["Level"], Color=jsonPayload["Color"], Idx=idx, \
+                        Type=device.Type, SubType=device.SubType, SwitchType=device.SwitchType)
+            # Send message to master Domoticz server
+            if fields != None and fields != {}:
+                apiParameters = ""
+                for field in fields:
+                    apiParameters += "&"+field+"="+str(fields[field])
+                apiParameters = "?" + apiParameters[1:]
+                if variables.debugEnabled:
+                    Domoticz.Debug(F"{marker} Update parameters={apiParameters}")
+                # Add command to update queue when rate limit allows it (toggles can't replace a previous command)
+                variables.commandLimiter.Submit(idx, apiParameters, jsonPayload["Command"] != "Toggle")
         else:
-            Domoticz.Error(F"{marker} Unexpected topic {topic}, payload {payload}")
+            Domoticz.Error(F"{marker} Remote changes not allowed for idx {idx}")
+    else:
+        Domoticz.Error(F"{marker} Can't find idx {idx} in {link.idxSet}")
+
+# Called after a message has been received on masterParameters topic on slave
+#   Here, we receive a parameters values message from master (either at startup as retained, or dynamically)
+def onMasterParametersReceived(idx, payload):
+    applyMasterParameters(idx, decodePayload(payload, DeviceParameters.fields))
+
+# Called after a message has been received on masterValues topic on slave
+def onMasterValuesReceived(idx, payload):
+    applyMasterValues(idx, decodePayload(payload, DeviceValues.fields))
+
+# Called after a message has been received on masterBatch topic on slave (values of multiple devices)
+def onMasterBatchReceived(payload):
+    # Compressed frames start with zlib header (0x78), never with a JSON character
+    if payload[:1] == b"x":
+        payload = zlib.decompress(payload)
+    jsonPayload = json.loads(payload)
+    for idx in jsonPayload:
+        values = jsonPayload[idx]
+        if type(values) == list:
+            values = compactToDict(values, DeviceValues.fields)
+        applyMasterValues(idx, values)
 
 # Called after name2idx request data received
 def onHttpName2idx(Connection, result):
@@ -1008,6 +2687,11 @@ def onHttpBackupDatabase(Connection, data):
     # Write database copy
     with open(variables.databaseCopyFileName, "wb") as dbStream:
         dbStream.write(data)
+    loadDefinitionsFromDatabaseCopy()
+
+# Load device definitions from database copy, then delete it
+def loadDefinitionsFromDatabaseCopy():
+    marker = makeMarker("loadDefinitionsFromDatabaseCopy")
     # Open database copy
     variables.databaseConnecion = sqlite3.connect(variables.databaseCopyFileName)
     loadDefinitionsFromDb()
@@ -1021,6 +2705,8 @@ def onHttpBackupDatabase(Connection, data):
 # Called on plug-in statup
 def onStart():
     marker = makeMarker("onStart")
+    variables.metrics = Metrics()
+    variables.scheduler = Scheduler()
     # Load settings
     loadSettings()
 
@@ -1028,16 +2714,60 @@ def onStart():
     if not variables.initDone:
         return
 
+    # Index existing devices by DeviceID and load free units
+    buildDeviceIndex()
+    buildFreeUnits()
+
     # First operation depends on run mode
     if variables.areWeOnMaster:
+        # Prepare sending slave updates to Domoticz
+        variables.apiUpdateSender = ApiUpdateSender(variables.sendSlaveUpdateConnection, \
+            variables.domoticzAddress, variables.domoticzPort, variables.domoticzHttps)
+        variables.commandLimiter = RateLimiter("apiUpdates", variables.commandRate, variables.commandBurst, \
+            variables.apiUpdateSender.Add)
+        # Serve slaves from state saved by previous run, device definitions being refreshed in background
+        if loadMasterState():
+            for link in variables.slaveLinks:
+                connectToMqttSlaveOnMaster(link)
         # Ask for name to idx data
         requestName2IdxData()
     else:
-        # Connect to slave MQTT (from slave)
-        connectToMqttSlaveOnSlave()
+        # Load parameters fingerprints and versions applied, then connect to slave MQTT (from slave)
+        loadParametersFingerprints()
+        loadSlaveCache()
+        variables.commandLimiter = RateLimiter("commands", variables.commandRate, variables.commandBurst, sendSlaveCommand)
+        connectToMqttSlaveOnSlave(variables.slaveLinks[0])
+
+    # Schedule periodic tasks
+    if not variables.areWeOnMaster:
+        scheduleTask("slaveState", variables.pingInterval, onSlaveStateTimer, interval=variables.pingInterval)
+    if variables.areWeOnMaster and variables.stateSaveInterval > 0:
+        scheduleTask("saveState", variables.stateSaveInterval, saveMasterState, interval=variables.stateSaveInterval)
+    if variables.statsInterval > 0:
+        scheduleTask("stats", variables.statsInterval, publishStats, interval=variables.statsInterval)
+    setHeartbeat()
+
+# Called on plug-in stop
+def onStop():
+    # Exit if init not properly done
+    if not variables.initDone:
+        return
+    # Don't lose commands held by rate limit
+    if variables.commandLimiter != None:
+        variables.commandLimiter.Flush()
+    if variables.areWeOnMaster:
+        # Save (clean) state for next start, values not yet sent to slaves being sent then
+        versionUnsentValues()
+        saveMasterState(clean=True)
+    else:
+        saveParametersFingerprints()
+        saveSlaveCache()
 
-    # Enable heartbeat
-    Domoticz.Heartbeat(30)
+# Publish slave state, save parameters fingerprints and versions applied, if changed (on slave)
+def onSlaveStateTimer():
+    publishSlaveState(variables.slaveLinks[0])
+    saveParametersFingerprints()
+    saveSlaveCache()
 
 # Called when user change a device state
 def onCommand(Unit, Command, Level, sColor):
@@ -1055,15 +2785,28 @@ def onCommand(Unit, Command, Level, sColor):
         fields["Level"] = Level
         fields["Color"] = sColor
         fields["LastUpdate"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        idx = device.DeviceID
-        # Publish change *WITHOUT* retain flag
-        if variables.slaveMqttClient != None:
-            if variables.slaveMqttClient.connection.Connected():
-                Domoticz.Log(F"{marker} Sending idx {idx} to master with payload {str(fields)}")
-                variables.slaveMqttClient.Publish(F"{variables.rootTopic}/{variables.slaveValues}/{idx}", json.dumps(fields), retain=False)
+        # Send command when rate limit allows it, only last one being sent if too fast (toggles are always sent)
+        variables.commandLimiter.Submit(device.DeviceID, fields, Command != "Toggle")
     else:
         Domoticz.Log(F"{marker} Update from {device.Name} (master idx {device.DeviceID}) forbidden")
 
+# Send a command to master (on slave)
+def sendSlaveCommand(idx, fields, replaceable):
+    marker = makeMarker("sendSlaveCommand", ignore=True)
+    link = variables.slaveLinks[0]
+    # Publish change *WITHOUT* retain flag
+    if variables.commandQos == 1 and link.mqttClient != None:
+        # Message id lets master ignore commands received twice
+        variables.commandCounter += 1
+        fields["MessageId"] = F"{variables.slaveSequence}/{variables.commandCounter}"
+        Domoticz.Log(F"{marker} Sending idx {idx} to master with payload {str(fields)}")
+        link.mqttClient.PublishAcknowledged(F"{link.rootTopic}/{variables.slaveValues}/{idx}", \
+            encodeCommand(link, fields), retain=0)
+    elif link.mqttClient != None:
+        if link.mqttClient.connection.Connected():
+            Domoticz.Log(F"{marker} Sending idx {idx} to master with payload {str(fields)}")
+            link.mqttClient.PublishBytes(F"{link.rootTopic}/{variables.slaveValues}/{idx}", encodeCommand(link, fields), retain=False)
+
 # Called when a new device is added
 def onDeviceAdded(Unit):
     # Exit if init not properly done
@@ -1071,6 +2814,8 @@ def onDeviceAdded(Unit):
         return
     marker = makeMarker("onDeviceAdded", ignore=True)
     Domoticz.Log(F"{marker} {deviceStr(Unit)}")
+    indexDevice(Unit)
+    claimUnit(Unit)
 
 # Called when a device is modified by script
 def onDeviceModified(self, Unit):
@@ -1087,127 +2832,181 @@ def onDeviceRemoved(Unit):
         return
     marker = makeMarker("onDeviceRemoved", ignore=True)
     Domoticz.Log(F"{marker} {deviceStr(Unit)}")
+    deviceId = variables.unit2DeviceId.get(Unit)
+    # Ignore late removal of a device already recreated on same unit (type change), keeping new one indexed
+    if Unit in Devices and str(Devices[Unit].DeviceID) == deviceId:
+        return
+    # Forget parameters of removed device, to recreate it if needed
+    if deviceId in variables.parametersFingerprints:
+        del variables.parametersFingerprints[deviceId]
+        variables.parametersFingerprintsChanged = True
+    if deviceId in variables.appliedParameters or deviceId in variables.appliedValues:
+        variables.appliedParameters.pop(deviceId, None)
+        variables.appliedValues.pop(deviceId, None)
+        variables.appliedAllowed.pop(deviceId, None)
+        variables.slaveCacheChanged = True
+    unindexDevice(Unit)
+    releaseUnit(Unit)
 
 # Called when a connection is opened
 def onConnect(Connection, Status, Description):
-    marker = makeMarker("onConnect", instance=F"{Connection.Name}", parameters=F"Status {str(Status)}, Description {str(Description)}")
-    if Connection.Name == variables.name2IdxConnection \
+    marker = makeMarker("onConnect", instance=F"{Connection.Name}", parameters=lambda: F"Status {str(Status)}, Description {str(Description)}")
+    if Status != 0 and Connection.Name == variables.sendSlaveUpdateConnection:
+        variables.apiUpdateSender.OnConnectFailed(Status, Description)
+    elif Connection.Name == variables.name2IdxConnection \
             or Connection.Name == variables.backupDatabaseConnection \
             or Connection.Name == variables.sendSlaveUpdateConnection:
         onHttpConnected(Connection)
+    elif Status != 0 and (Connection.Name == variables.masterConnection or Connection.Name in variables.slaveLinkByConnection):
+        onMqttConnectFailed(Connection, Status, Description)
     elif Connection.Name == variables.masterConnection:
         onMasterConnected(Connection)
-    elif Connection.Name == variables.slaveConnection:
-        onSlaveConnected(Connection)
+    elif Connection.Name in variables.slaveLinkByConnection:
+        onSlaveConnected(variables.slaveLinkByConnection[Connection.Name], Connection)
     else:
         Domoticz.Error(F"{marker} Unexpected Status {Status}, Description {Description}")
-    
+
+# Called when a MQTT connection can't be opened
+#   Only first failure is reported, connection being reopened later, waiting longer after each failure
+def onMqttConnectFailed(Connection, Status, Description):
+    marker = makeMarker("onMqttConnectFailed", instance=Connection.Name)
+    client = getMqttClient(Connection.Name)
+    if client != None and client.failures <= 1:
+        Domoticz.Error(F"{marker} Can't connect to {client.address}:{client.port} ({Description}), will retry")
+    scheduleKeepAlive()
+
 # Called when a conection is disconnected
 def onDisconnect(Connection):
     marker = makeMarker("onDisconnect", instance=F"{Connection.Name}")
-    # Delete slave MQTT client if disconnected
-    if Connection.Name == variables.slaveConnection:
-        variables.slaveMqttClient = None
-
-# Called when a message is received on a connection
-def onMessage(Connection, Data):
-    if Connection.Name == variables.name2IdxConnection:
-        marker = makeMarker("onMessage", instance=F"{Connection.Name}")
-        Status = int(Data["Status"])
-        if Status == 200:
-            strData = Data["Data"].decode("utf-8", "ignore")
-            if Connection.Connected():
-                Connection.Disconnect()
-            try:
-                jsonData = json.loads(strData)
-            except ValueError as e:
-                Domoticz.Error(F"Error {e} decoding json data")
-                return
-            result = getValue(jsonData, "result")
-            onHttpName2idx(Connection, result)
-        else:
-            Domoticz.Error(F"{marker} Error {Status} returned by HTTP")
-    elif Connection.Name == variables.backupDatabaseConnection:
-        marker = makeMarker("onMessage", instance=F"{Connection.Name}")
-        Status = int(Data["Status"])
-        if Status == 200:
-            strData = Data["Data"]
-            if Connection.Connected():
-                Connection.Disconnect()
-            onHttpBackupDatabase(Connection, strData)
-        else:
-            Domoticz.Error(F"{marker} Error {Status} returned by HTTP")
+    # Slave MQTT disconnected: stop waiting for ping answer and reconnect later (MQTT client is kept)
+    if Connection.Name in variables.slaveLinkByConnection:
+        link = variables.slaveLinkByConnection[Connection.Name]
+        link.burstCount = 0
+        link.waitingPingResp = False
+        variables.scheduler.Cancel(F"burst.{link.name}")
+        scheduleKeepAlive()
+    # Master MQTT disconnected, reconnect later
+    elif Connection.Name == variables.masterConnection:
+        scheduleKeepAlive()
+    # Slave updates connection closed
     elif Connection.Name == variables.sendSlaveUpdateConnection:
-        marker = makeMarker("onMessage", instance=F"{Connection.Name}")
-        Status = int(Data["Status"])
-        if Status == 200:
-            sendNextSlaveUpdate()
-        else:
-            Domoticz.Error(F"{marker} Error {Status} returned by HTTP - Data {Data['Data']}")
-    elif Connection.Name == variables.masterConnection or Connection.Name == variables.slaveConnection:
-        marker = makeMarker("onMessage", instance=F"{Connection.Name}", parameters=F"Data: {Data}", ignore=True)
+        variables.apiUpdateSender.OnDisconnected()
+    # End of streamed database copy
+    elif Connection.Name == variables.backupDatabaseConnection and variables.backupReader != None:
+        onHttpBackupDatabaseStreamDisconnected(Connection)
+
+# Called when a message is received on name2idx HTTP connection
+def onHttpName2IdxMessage(Connection, Data):
+    marker = makeMarker("onHttpName2IdxMessage", instance=F"{Connection.Name}")
+    Status = int(Data["Status"])
+    if Status == 200:
+        strData = Data["Data"].decode("utf-8", "ignore")
+        if Connection.Connected():
+            Connection.Disconnect()
+        try:
+            jsonData = json.loads(strData)
+        except ValueError as e:
+            Domoticz.Error(F"Error {e} decoding json data")
+            return
+        result = getValue(jsonData, "result")
+        onHttpName2idx(Connection, result)
+    else:
+        Domoticz.Error(F"{marker} Error {Status} returned by HTTP")
+
+# Called when a message is received on backup database HTTP connection
+def onHttpBackupDatabaseMessage(Connection, Data):
+    if variables.backupReader != None:
+        onHttpBackupDatabaseStream(Connection, Data)
+        return
+    marker = makeMarker("onHttpBackupDatabaseMessage", instance=F"{Connection.Name}")
+    Status = int(Data["Status"])
+    if Status == 200:
+        strData = Data["Data"]
+        if Connection.Connected():
+            Connection.Disconnect()
+        onHttpBackupDatabase(Connection, strData)
+    else:
+        Domoticz.Error(F"{marker} Error {Status} returned by HTTP")
+
+# Called when a message is received on slave updates HTTP connection
+def onSendSlaveUpdateMessage(Connection, Data):
+    marker = makeMarker("onSendSlaveUpdateMessage", instance=F"{Connection.Name}")
+    Status = int(Data["Status"])
+    if Status != 200:
+        Domoticz.Error(F"{marker} Error {Status} returned by HTTP - Data {Data['Data']}")
+    variables.apiUpdateSender.OnResponse(Status)
+
+# Called when a message is received on master or slave MQTT connection
+def onMqttMessage(Connection, Data):
+    marker = makeMarker("onMqttMessage", instance=Connection.Name, ignore=True)
+    link = variables.slaveLinkByConnection.get(Connection.Name)
+    verb = Data['Verb']
+
+    # Is this a publish message (after subscription)?
+    if verb == "PUBLISH":
         # Extract data and topic of MQTT message
         topic = Data['Topic'] if 'Topic' in Data else ""
         payload = Data['Payload'] if 'Payload' in Data else ""
-
-        # Is this a connection ACK?
-        if Data['Verb'] == "CONNACK":
-            Domoticz.Log(F"{marker} Connection established")
-            if Connection.Name == variables.masterConnection:
-                onMasterMqttConAck(Connection)
-            elif Connection.Name == variables.slaveConnection:
-                onSlaveMqttConAck(Connection)
-            else:
-                Domoticz.Error(F"{marker} Unexpected Data {str(Data)}")
-        # Is this a subcription ACK?
-        elif Data['Verb'] == "SUBACK":
-            # Is this an acknoledgment of domoticz/out topic on master MQTT?
-            if Connection.Name == variables.masterConnection:
-                if variables.masterMqttClient != None:
-                    topics = variables.masterMqttClient.lastSubscribedTopics
-                else:
-                    topics = "???"
-                Domoticz.Log(F"{marker} Topics {topics} subscribed")
-                onMasterMqttSubAck(Connection, topics)
-            elif Connection.Name == variables.slaveConnection:
-                pass    # Don't care about subscription ack for slave on slave and on master
-            else:
-                Domoticz.Error(F"{marker} Unexpected Data {str(Data)}")
-        # Is this a publish message (after subscription)?
-        elif Data['Verb'] == "PUBLISH":
+        if variables.logMqttMessages:
             Domoticz.Log(F"{marker} Topic {str(topic)}, payload >{payload}<")
-            # Is this a message from domoticz/out topic on master MQTT?
-            if Connection.Name == variables.masterConnection:
-                onMasterReceived(Connection, topic, payload)
-            elif Connection.Name == variables.slaveConnection:
-                onSlaveReceived(Connection, topic, payload)
-            else:
-                Domoticz.Error(F"{marker} Unexpected Data {str(Data)}")
-        elif Data['Verb'] == "PINGRESP":
-            pass
+        startTime = time.perf_counter()
+        if variables.topicRouter.Dispatch(Connection.Name, topic, payload):
+            variables.metrics.Observe("onMasterReceived" if link == None else "onSlaveReceived", \
+                time.perf_counter() - startTime, variables.durationBuckets)
+        else:
+            Domoticz.Error(F"{marker} Unexpected topic {topic}, payload {payload}")
+        # Acknowledge QoS 1 messages once handled
+        if Data.get('QoS', 0) == 1 and 'PacketIdentifier' in Data:
+            Connection.Send({'Verb': 'PUBACK', 'PacketIdentifier': Data['PacketIdentifier']})
+    elif verb == "PUBACK":
+        client = getMqttClient(Connection.Name)
+        if client != None:
+            client.OnPubAck(Data['PacketIdentifier'])
+    elif verb == "PINGRESP":
+        if link != None:
+            onSlaveMqttPingResp(link)
+    # Is this a connection ACK?
+    elif verb == "CONNACK":
+        Domoticz.Log(F"{marker} Connection established")
+        if link != None:
+            onSlaveMqttConAck(link, Connection)
         else:
-            Domoticz.Error(F"{marker} Unexpected Data {str(Data)}")
+            onMasterMqttConAck(Connection)
+    # Is this a subcription ACK?
+    elif verb == "SUBACK":
+        # Is this an acknoledgment of domoticz/out topic on master MQTT?
+        if link == None:
+            if variables.masterMqttClient != None:
+                topics = variables.masterMqttClient.lastSubscribedTopics
+            else:
+                topics = "???"
+            Domoticz.Log(F"{marker} Topics {topics} subscribed")
+            onMasterMqttSubAck(Connection, topics)
+        # Don't care about subscription ack for slave on slave and on master
+    else:
+        Domoticz.Error(F"{marker} Unexpected Data {str(Data)}")
+
+# Called when a message is received on a connection
+def onMessage(Connection, Data):
+    # Counter names are composed once per connection
+    counter = variables.receivedCounters.get(Connection.Name)
+    if counter == None:
+        counter = F"received.{Connection.Name}"
+        variables.receivedCounters[Connection.Name] = counter
+    variables.metrics.Count(counter)
+    handler = variables.messageHandlers.get(Connection.Name)
+    if handler != None:
+        handler(Connection, Data)
     else:
         marker = makeMarker("onMessage", instance=F"{Connection.Name}", ignore=True)
         Domoticz.Error(F"{marker} Unexpected Data {str(Data)}")
 
 # Called at regular interval by plug-in
+#   Runs due tasks, then sets heartbeat to next task due time
 def onHeartbeat():
     # Exit if init not properly done
     if not variables.initDone:
         return
     marker = makeMarker("onHeartbeat", ignore=(variables.debugging != "Verbose+"))
-
-    # Send ping or (try to) reconnect master MQTT
-    if variables.masterMqttClient != None:
-        if variables.masterMqttClient.connection.Connected():
-            variables.masterMqttClient.Ping()
-        else:
-            variables.masterMqttClient.Open()
-
-    # Send ping or (try to) reconnect slave MQTT
-    if variables.slaveMqttClient != None:
-        if variables.slaveMqttClient.connection.Connected():
-            variables.slaveMqttClient.Ping()
-        else:
-            variables.slaveMqttClient.Open()
\ No newline at end of file
+    variables.scheduler.RunDue(time.time())
+    setHeartbeat()
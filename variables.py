@@ -6,13 +6,13 @@ masterMqttPort = ""                             # Master MQTT server port
 masterMqttUser = ""                             # Master MQTT username
 masterMqttPassword = ""                         # Master MQTT password
 masterSequence = ""                             # Master sequence id
-slaveName = ""                                  # Name of slave MQTT server
-slaveMqttClient = None                          # Slave MQTT client object
-slaveMqttHost = ""                              # Slave MQTT server address
-slaveMqttPort = ""                              # Slave MQTT server port
-slaveMqttUser = ""                              # Slave MQTT username
-slaveMqttPassword = ""                          # Slave MQTT password
 slaveSequence = ""                              # Slave sequence id
+slaveLinks = []                                 # Slave links (all slaves fed by master, only our slave on slave)
+slaveLinkByName = {}                            # Slave link by slave name
+slaveLinkByConnection = {}                      # Slave link by MQTT connection name
+slaveQueueBurst = 100                           # Count of messages sent to a slave before waiting for broker ping answer
+messageHandlers = {}                            # Message handler by connection name
+topicRouter = None                              # MQTT topic router
 slaveDevicePrefix = ""                          # Prefix to add to device names on Slave
 slaveUpdateAllowed = {}                         # Slave local devices idx update allowed on master
 domoticzUrl = ""                                # Domoticz URL
@@ -27,22 +27,87 @@ initDone = False                                # Clear init flag
 settings = None                                 # Configuration settings
 mapping = None                                  # Configuration mapping
 debugging = "Normal"                            # Debug level
+debugEnabled = False                            # Are debug messages enabled (set from debug level)?
+markerCache = {}                                # Already composed markers
+logMqttMessages = False                         # Log each received MQTT message?
 name2IdxConnection = "name2idx"                 # name2Idx HTTP connection name
 backupDatabaseConnection = "backupDatabase"     # Device list HTTP connection name
 sendSlaveUpdateConnection = "sendSlaveUpdate"   # Send slave update
 masterConnection = "Master"                     # MQTT master connection name
-slaveConnection = "Slave"                       # MQTT master connection name
+slaveConnection = "Slave"                       # MQTT slave connection name prefix
 syncDevices = {}                                # Synchronized devices values dictionary
 syncParameters = {}                             # Synchronized devices parameters
-name2Idx = {}                                   # Name to IDX dictionary
-idxList = []                                    # List of known idxes
-rootTopic = ""                                  # Root Mqttsync topic
+deviceCatalog = None                            # Catalog of known devices (idx and names)
+rootTopic = ""                                  # Root Mqttsync topic on master MQTT
 masterValues = "masterValues"                   # Master values sub-topic
 masterParameters = "masterParameters"           # Master parameters sub-topic
 slaveValues = "slaveValues"                     # Slave values sub-topic
+masterBatch = "masterBatch"                     # Master batched values sub-topic
+slaveState = "slaveState"                       # Slave state (last version applied) sub-topic
+statsTopic = "stats"                            # Stats sub-topic
 databaseCopyFileName = ""                       # Name of database copy file
 databaseConnecion = None                        # Database connection
+backupReader = None                             # Streamed database copy reader
+sqlMaxVariables = 500                           # Maximum count of variables in a SQL request
+definitionsSource = "auto"                      # Device definitions source (auto, database or backup)
 pluginVersion = "1.0.0"                         # That's written on it ;-)
 areWeOnMaster = True                            # Are we running on master (else on slave)?
 runMode = "Master"                              # Run mode (Master or Slave)
-sendApiUpdateList = []                          # List of device update to send to master Domoticz
\ No newline at end of file
+commandRate = 0                                 # Commands sent per second for a device (0 for no limit), next ones being coalesced
+commandBurst = 2                                # Commands sent at once for a device before rate limit applies
+commandLimiter = None                           # Rate limiter of commands (slave commands on slave, API updates on master)
+apiUpdateSender = None                          # Sender of device updates to master Domoticz
+apiMaxRetries = 5                               # Maximum retries of a device update to master Domoticz
+apiRetryDelay = 2                               # Delay before first retry (doubled at each consecutive error)
+apiRetryMaxDelay = 120                          # Maximum delay between retries
+deviceId2Unit = {}                              # DeviceID (master idx) to Unit index
+unit2DeviceId = {}                              # Unit to DeviceID (master idx) index
+freeUnits = []                                  # Heap of free device units below nextFreeUnit
+freeUnitsSet = set()                            # Set of free device units (heap members still valid)
+nextFreeUnit = 1                                # Lowest unit above all used ones
+publishFilters = {}                             # Publish filter of devices (idx -> mode, deadband, minInterval)
+batchWindow = 0                                 # Batch window in seconds (0 to send each value separately)
+batchMaxDevices = 200                           # Send batch as soon as it contains this count of devices
+snapshotInterval = 60                           # Interval between refresh of retained values sent in batches
+compactEncoding = False                         # Use compact encoding with peer instance, if it supports it?
+encodings = ["compact", "zlib"]                 # Encodings supported (advertised in slave MQTT LWT when compact encoding is enabled)
+compressMinSize = 256                           # Minimum size of a batch frame to compress it (bytes)
+commandFields = ("Command", "Level", "Color", "LastUpdate", "MessageId")  # Fields of slave commands, in compact encoding order
+commandQos = 0                                  # MQTT QoS of slave commands sent to master (0 or 1)
+qosWindow = 10                                  # Maximum count of QoS 1 messages sent and not yet acknowledged
+qosMaxWaiting = 1000                            # Maximum count of QoS 1 messages waiting for in-flight window
+commandCounter = 0                              # Last slave command number (part of command message id)
+maxReceivedMessageIds = 1000                    # Count of last slave command message ids kept to detect duplicates
+pingInterval = 30                               # MQTT ping interval (seconds)
+reconnectDelay = 5                              # Delay before reopening a MQTT connection after first failure (seconds)
+reconnectMaxDelay = 600                         # Maximum delay between MQTT connection attempts (seconds)
+scheduler = None                                # Timed tasks scheduler
+heartbeatInterval = 0                           # Current heartbeat interval (seconds)
+maxHeartbeat = 30                               # Maximum heartbeat interval allowed by Domoticz (seconds)
+versionCounter = 0                              # Last version given to a device change (on master)
+resyncTimeout = 10                              # Send everything if slave state not received within this delay
+appliedSequence = ""                            # Master sequence of last change applied (on slave)
+appliedVersion = 0                              # Last version applied (on slave)
+publishedSlaveState = None                      # Last slave state published
+waitingValues = {}                              # Values received on slave before device parameters (idx -> values)
+maxWaitingValues = 5000                         # Maximum count of idx in waitingValues
+parametersFingerprints = {}                     # Fingerprint of last parameters applied on slave (idx -> fingerprint)
+parametersFingerprintsChanged = False           # Should fingerprints be saved?
+parametersFingerprintsFileName = ""             # Name of fingerprints file
+appliedParameters = {}                          # Sequence and version of last parameters applied on slave (idx -> (sequence, version))
+appliedValues = {}                              # Sequence and version of last values applied on slave (idx -> (sequence, version))
+appliedAllowed = {}                             # Update allowed flag of last values applied on slave (idx -> allowSlaveUpdate)
+slaveCacheChanged = False                       # Should slave cache be saved?
+slaveCacheFileName = ""                         # Name of slave cache file (applied versions)
+stateFileName = ""                              # Name of master state file (used for warm start)
+stateSaveInterval = 60                          # Interval between master state saves in seconds (0 to disable warm start)
+savedStateVersion = 0                           # Last version saved in master state file
+restoredVersion = 0                             # Last version restored from master state file (later ones are changes of this run)
+metrics = None                                  # Metrics (counters and histograms)
+receivedCounters = {}                           # Name of received messages counter by connection name
+statsInterval = 60                              # Interval between stats publications in seconds (0 to disable)
+statsDevices = False                            # Also show main stats in Domoticz (custom sensor) devices?
+statsDeviceIdPrefix = "mqttSyncStats_"          # Prefix of stats devices DeviceID (not to collide with master idx)
+durationBuckets = [0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1]  # Handling time buckets (s)
+latencyBuckets = [0.5, 1, 2, 5, 10, 30, 60, 300]   # Master to slave latency buckets (s)
+depthBuckets = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000]  # Queue depth buckets